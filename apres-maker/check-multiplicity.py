@@ -3,75 +3,76 @@
 import sys
 import re
 
-from gfftools import GFF as GFF
+from gfftools import FeatureTable
+from gfftools import open_file
 
 gff = sys.argv[1]
 multi = {} # ID: count
 
-with open(gff,"r") as file_object:
-    for line in file_object:
-
-        if line[0] == "#":
-            continue
+# parse the gff once into a table; reruns reload the snapshot saved beside it
+table = FeatureTable.cached(gff)
 
-        feat = GFF(line)
+for row in table.rows("mRNA",source="gmap"):
+    feat_id = table.ids[row]
 
-        if feat.source == "gmap" and feat.type == "mRNA":
+    cch = feat_id.split("-")
+    deriv = ''
+    x = 0
 
-            cch = feat.id.split("-")
-            deriv = ''
+    for i in cch:
+        if i == "CCH":
+            deriv = i
+            x = 1
+        elif i == "mRNA" or i == "lncRNA":
             x = 0
+        elif x == 1:
+            deriv += "-" + i
 
-            for i in cch:
-                if i == "CCH":
-                    deriv = i
-                    x = 1
-                elif i == "mRNA" or i == "lncRNA":
-                    x = 0
-                elif x == 1:
-                    deriv += "-" + i
-
-            if deriv not in multi:
-                multi[deriv] = 1
-            else:
-                multi[deriv] += 1
+    if deriv not in multi:
+        multi[deriv] = 1
+    else:
+        multi[deriv] += 1
 
 mates={}
-with open(gff,"r") as file_object:
-    for line in file_object:
-        if line[0] == "#":
-            continue
-        feat = GFF(line)
-        if feat.source == "maker":
-            continue
-        elif feat.source == "gmap":
-            cch = feat.id.split("-")
-            deriv = ''
+for row in table.rows(source="gmap"):
+    feat_id = table.ids[row]
+    cch = feat_id.split("-")
+    deriv = ''
+    x = 0
+    for i in cch:
+        if i == "CCH":
+            deriv = i
+            x = 1
+        elif i == "mRNA" or i == "lncRNA" or i == "gene":
             x = 0
-            for i in cch:
-                if i == "CCH":
-                    deriv = i
-                    x = 1
-                elif i == "mRNA" or i == "lncRNA" or i == "gene":
-                    x = 0
-                elif x == 1:
-                    deriv += "-" + i
-            if len(re.findall("mRNA-1",feat.id)) > 0:
-                mates[deriv]={'1':[re.sub('-mRNA-1','',feat.id.split(":")[0]),feat.seqid]}
-            elif len(re.findall("mRNA-2",feat.id)) > 0:
-                mates[deriv]['2']=[re.sub('-mRNA-2','',feat.id.split(":")[0]),feat.seqid]
+        elif x == 1:
+            deriv += "-" + i
+    feat_seqid = table.seqids[table.seqid[row]]
+    if len(re.findall("mRNA-1",feat_id)) > 0:
+        mates[deriv]={'1':[re.sub('-mRNA-1','',feat_id.split(":")[0]),feat_seqid]}
+    elif len(re.findall("mRNA-2",feat_id)) > 0:
+        mates[deriv]['2']=[re.sub('-mRNA-2','',feat_id.split(":")[0]),feat_seqid]
 
-with open(gff,"r") as file_object:
+# the lines are written back out as they are, so stream the file, taking each
+#  feature's columns from its table row
+row = 0
+fasta = False
+with open_file(gff) as file_object:
     for line in file_object:
-        if line[0] == "#":
+        if line.startswith("##FASTA"):
+            fasta = True
+        if fasta or line[0] == "#" or not line.strip():
             sys.stdout.write(line)
             continue
-        feat = GFF(line)
-        if feat.source == "maker":
+        feat_source = table.sources[table.source[row]]
+        feat_type = table.types[table.type[row]]
+        feat_id = table.ids[row]
+        row += 1
+        if feat_source == "maker":
             sys.stdout.write(line)
             continue
-        elif feat.source == "gmap":
-            cch = feat.id.split("-")
+        elif feat_source == "gmap":
+            cch = feat_id.split("-")
             deriv = ''
             x = 0
             for i in cch:
@@ -82,15 +83,15 @@ with open(gff,"r") as file_object:
                     x = 0
                 elif x == 1:
                     deriv += "-" + i
-            if feat.type != "mRNA" and feat.type != "ncRNA": ##
+            if feat_type != "mRNA" and feat_type != "ncRNA": ##
                 sys.stdout.write(line)
             else:
                 if '2' not in mates[deriv]:
                     sys.stdout.write(line)
                 else:
-                    if len(re.findall("mRNA-1",feat.id)) > 0:
+                    if len(re.findall("mRNA-1",feat_id)) > 0:
                         sys.stdout.write(line.strip("\n")+";note=5' end_ 3' end is gene "+mates[deriv]['2'][0]+" on scaffold "+mates[deriv]['2'][1]+"\n")
-                    elif len(re.findall("mRNA-2",feat.id)) > 0:
+                    elif len(re.findall("mRNA-2",feat_id)) > 0:
                         sys.stdout.write(line.strip("\n")+";note=3' end_ 5' end is gene "+mates[deriv]['1'][0]+" on scaffold "+mates[deriv]['1'][1]+"\n")
 
 ### EOF ###
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
+import os
 import sys
 import re
 
-from gfftools import GFF
+from gfftools import GFF, open_file
 from fastatools import fasta_iter
 
 def main():
@@ -19,23 +20,28 @@ def main():
     gff = sys.argv[1]
     fasta = sys.argv[2]
 
-    seqs = set()
-
-    with open(fasta,"r") as fastafile:
-        for rec in fasta_iter(fastafile):
-            seqs.add(rec[0])
+    # only the sequence names are needed: take them from a .fai index if
+    #  one is already there, else scan the headers
+    fai = fasta + ".fai"
+    if os.path.exists(fai) and os.path.getmtime(fai) >= os.path.getmtime(fasta):
+        with open(fai,"r") as faifile:
+            seqs = set(line.split("\t",1)[0] for line in faifile)
+    else:
+        with open_file(fasta) as fastafile:
+            seqs = set(header.split()[0] for header,seq in fasta_iter(fastafile))
 
     # clumsy way of getting base name of fasta file
     fastaname = re.sub(".fa","",re.sub(".fasta","",fasta))
 
     outfile = open(fastaname + ".gff","w")
 
-    with open(gff,"r") as file_object:
+    with open_file(gff) as file_object:
         for line in file_object:
             if line[0] == "#":
                 continue
 
-            feature = GFF(line)
+            # only the seqid is needed, so leave column 9 undecoded
+            feature = GFF(line,lazy=True)
 
             if feature.seqid in seqs:
                 outfile.write(line)
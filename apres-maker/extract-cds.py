@@ -5,63 +5,82 @@ import sys
 import gfftools
 import fastatools
 
+# genome.fa, opened on first use in each process that reads from it
+FASTA = None
+sequences = None
+
+def cds_fasta(seqid,builder):
+    """FASTA text of the CDS of each transcript on one scaffold, and the
+    number of Parent IDs whose CDS had no transcript under a gene line"""
+    global sequences
+    if sequences is None:
+        # serve CDS slices from the .fai index (or a packed genome from
+        # pack-fasta.py) rather than loading the genome as strings
+        sequences = fastatools.open_genome(FASTA)
+
+    # CDS of transcripts the builder placed under a gene, plus those left
+    #  waiting for a transcript (or whose transcript has no gene), grouped
+    #  by the Parent ID they name
+    records = {}
+    for record,transcript in builder.transcripts.iteritems():
+        if transcript.cds:
+            records[record] = transcript.cds
+    orphans = 0
+    for record,features in builder.orphans.iteritems():
+        cds = [feature for feature in features if feature.type == "CDS"]
+        if cds and record not in records:
+            records[record] = sorted(cds,key=lambda x: x.istart)
+            orphans += 1
+
+    out = []
+    for record in sorted(records,key=lambda x: (records[x][0].istart,x)):
+        # segments are in start order, so read them backwards on the - strand
+        pieces = []
+        for feature in records[record]:
+            piece = sequences.fetch(seqid,feature.istart,feature.iend)
+            if feature.strand == "-":
+                pieces.insert(0,fastatools.revcomp(piece))
+            else:
+                pieces.append(piece)
+        out.append(">"+record+"_CDS\n"+"".join(pieces)+"\n")
+    return "".join(out),orphans
+
 def main():
     """Extract CDS coordinates for each mRNA in a gff file,
     then print the corresponding sequence.
-    The subfeatures MUST be sorted by their start coordinate
 
-    Usage: extract-cds.py genes.gff genome.fa > genes-cds.fa
+    Usage: extract-cds.py genes.gff genome.fa [jobs] > genes-cds.fa
+    genome.fa may also be a packed genome made by pack-fasta.py
+    With jobs > 1 an uncompressed gff is split between scaffolds and
+    the pieces are extracted in that many processes.
+    Each scaffold's lines must be together in the gff (e.g. sorted by
+    seqid); the order of the lines within a scaffold doesn't matter.
     """
 
-    if len(sys.argv) is not 3:
+    global FASTA
+
+    if len(sys.argv) not in (3,4):
         print main.__doc__
         sys.exit(1)
 
     gff=sys.argv[1]
-    fasta=sys.argv[2]
-
-    cds_coords = {}
-
-    with open(gff,"r") as file_object:
-        for line in file_object:
-            if line[0] == "#":
-                sys.stdout.write(line)
-                continue
-
-            feature = gfftools.GFF(line)
-
-            if feature.type == "CDS":
-                for parent in feature.parent:
-                    if parent in cds_coords:
-                        if feature.strand == "+":
-                            cds_coords[parent]['coords'].append([feature.start,feature.end])
-    
-                        else:
-                            cds_coords[parent]['coords'].insert(0,[feature.start,feature.end])
-    
-                    else:
-                        cds_coords[parent] = {'coords':[[feature.start,feature.end]],'scaf':feature.seqid,'strand':feature.strand}
-
-    sequences={}
-
-    with open(fasta,"r") as file_object:
-        for rec in fastatools.fasta_iter(file_object):
-            sequences[rec[0]] = rec[1]
-
-    for record in cds_coords:
-        whole = ""
-        for coords in cds_coords[record]['coords']:
-            seqid = cds_coords[record]['scaf']
-
-            if cds_coords[record]['strand'] == "-":
-                piece = fastatools.revcomp(sequences[seqid][int(coords[0])-1:int(coords[1])]) ### watch for OBO
-
-            else:
-                piece = sequences[seqid][int(coords[0])-1:int(coords[1])] ### watch for OBO
-
-            whole += piece
-        else:
-            sys.stdout.write(">"+record+"_CDS\n"+whole+"\n")
+    FASTA=sys.argv[2]
+    jobs=int(sys.argv[3]) if len(sys.argv) == 4 else 1
+
+    orphans = 0
+    done = set()
+    for seqid,(text,count) in gfftools.read_scaffolds(gff,jobs,cds_fasta):
+        # a scaffold's CDS are only grouped within one run of its lines
+        if seqid in done:
+            sys.stderr.write("The lines for " + seqid + " are not all together; "
+                             "sort the gff by seqid\n")
+            sys.exit(1)
+        done.add(seqid)
+        sys.stdout.write(text)
+        orphans += count
+    if orphans:
+        sys.stderr.write("Extracted the CDS of " + str(orphans) + " Parent IDs with no "
+                         "mRNA or ncRNA line under a gene line in the gff\n")
 
 if __name__ == "__main__":
     main()
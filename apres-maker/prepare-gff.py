@@ -5,6 +5,8 @@
 import sys as s
 import re
 from fastatools import fasta_iter as f
+from fastatools import open_file
+from alntools import best_hits, describe
 
 ############
 # parse arguments
@@ -71,7 +73,7 @@ def getScaf(seqid,idlen):
 # MAIN
 
 # read in the mrna entries from the gff file
-with open(gff,"r") as infile:
+with open_file(gff) as infile:
     for line in infile:
         if line[0] == "#" or line[0] == "-":
             continue
@@ -89,7 +91,7 @@ with open(gff,"r") as infile:
                 seen.add(mid)
 
 # read in the other entries from the gff
-with open(gff,"r") as infile:
+with open_file(gff) as infile:
     for line in infile:
         if line[0] == "#" or line[0] == "-":
             continue
@@ -267,29 +269,16 @@ for i in mrna:
 
 # add annotations to mrna lines
 # GAG will add them to the cds records in the tbl file
-with open(aln,"r") as blast:
-    for rec in blast:
-        # qid = 0, sid = 1, pid = 2, aln length = 3 (includes gaps)
-        thisaln=rec.split("\t")
-        if thisaln[0] not in aseen:
-            if thisaln[0] in present:
-#               cov=100*(float(thisaln[3])/float(len(mrna[thisaln[0]])))
-                cov=thisaln[-1]
-                if thisaln[2] >= MIN_IDENT and cov >= MIN_COV:
-                    thisannot=thisaln[-2].split(" ") ##
-                    refnam='' ##
-                    for i in range(0,len(thisannot)): ##
-                        if i == 0 and len(re.findall(BRK,thisannot[i])) < 1: ##
-                            refnam+=thisannot[i] ##
-                        elif i > 0 and len(re.findall(BRK,thisannot[i])) < 1: ##
-                            refnam+=SEPO+thisannot[i] ##
-                        else: ##
-                            break ##
-                    #mrna[thisaln[0]]['annot']=PRE+str(refnam[thisaln[1]])
-                    mrna[thisaln[0]]['annot']=PRE+SEPO+refnam
-                else:
-                    mrna[thisaln[0]]['annot']=UNK
-                aseen.add(thisaln[0])
+# only each query's best hit is considered
+for qid,hit in best_hits(aln).iteritems():
+    if qid in present:
+#       cov=100*(float(hit.length)/float(len(mrna[qid])))
+        if hit.pident >= MIN_IDENT and hit.qcovs >= MIN_COV:
+            #mrna[qid]['annot']=PRE+str(refnam[hit.sseqid])
+            mrna[qid]['annot']=PRE+SEPO+describe(hit.stitle,BRK,SEPO)
+        else:
+            mrna[qid]['annot']=UNK
+        aseen.add(qid)
 
 # add UNK to the contigs with no hits at all
 for i in mrna:
@@ -19,7 +19,7 @@ def main():
 
     idlist = sys.argv[1]
     gff = sys.argv[2]
-    outnam = re.sub(".gff","-selected.gff",gff)
+    outnam = gfftools.output_name(gff,"-selected.gff")
 
     ids = set()
     with open(idlist,"r") as file_object:
@@ -31,12 +31,12 @@ def main():
 
     outfile = open(outnam,"w")
 
-    with open(gff,"r") as file_object:
+    with gfftools.open_file(gff) as file_object:
         for line in file_object:
             if line[0] == "#":
 #                outfile.write(line)
                 continue
-            feature = gfftools.GFF(line)
+            feature = gfftools.GFF(line,lazy=True)
             if feature.id in ids:
                 outfile.write(line)
             else:
@@ -3,13 +3,166 @@
 # functions to work with fasta files
 # written by Austin Hammond, BCGSC 2015 (except for fasta_iter)
 
+import io
+import os
+import re
+import sys
+import gzip
+import mmap
+import zlib
+import bisect
+import string
+import struct
+import itertools
+import subprocess
 from itertools import groupby
+from distutils.spawn import find_executable
+
+GZIP_MAGIC = "\x1f\x8b"
+
+## open_file
+#
+#   open a plain, gzip or bgzip compressed text file for reading, judging
+#   by its first bytes rather than its name. "-" means stdin.
+#   with threads > 1, compressed files are decompressed by pigz or bgzip
+#   in a separate process when either is on the PATH; otherwise python's
+#   gzip module is used (which handles bgzip's concatenated blocks).
+def open_file(file_name, threads=1):
+    if file_name == "-":
+        return sys.stdin
+    with open(file_name, "rb") as infile:
+        magic = infile.read(2)
+    if magic != GZIP_MAGIC:
+        return open(file_name, "r")
+    if threads > 1:
+        for cmd in (["pigz", "-dc", "-p", str(threads)], ["bgzip", "-dc", "-@", str(threads)]):
+            if find_executable(cmd[0]):
+                return PipeReader(cmd + [file_name])
+    return io.BufferedReader(gzip.open(file_name, "rb"), 1048576)
+
+## PipeReader
+#
+#   read-only file-like wrapper around the output of a decompression
+#   command; closing it waits for the command and raises IOError if it
+#   failed
+class PipeReader(object):
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1048576)
+        self.read = self._proc.stdout.read
+        self.readline = self._proc.stdout.readline
+
+    def __iter__(self):
+        return iter(self._proc.stdout)
+
+    def close(self):
+        self._proc.stdout.close()
+        if self._proc.wait() not in (0, -13): # SIGPIPE if we stopped reading early
+            raise IOError(" ".join(self.cmd) + " failed")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+## is_bgzf
+#
+#   True if the file starts with a bgzip (BGZF) block, which allows random
+#   access; False for plain gzip and uncompressed files
+def is_bgzf(file_name):
+    with open(file_name, "rb") as infile:
+        header = infile.read(16)
+    return (len(header) == 16 and header[:2] == GZIP_MAGIC and
+            ord(header[3]) & 4 and header[12:14] == "BC")
+
+## BgzfReader
+#
+#   random access to the uncompressed contents of a bgzip file. uses the
+#   block offsets from a .gzi index (as written by bgzip -i) if one is
+#   present, or finds them by walking the block headers, which only reads a
+#   few bytes per 64 kb block. slicing (reader[start:end], in uncompressed
+#   bytes) decompresses just the blocks involved, so it can stand in for the
+#   memory map used by IndexedFasta.
+class BgzfReader(object):
+
+    def __init__(self, file_name, gzi_name=None):
+        self.file_name = file_name
+        if gzi_name is None:
+            gzi_name = file_name + ".gzi"
+        self._handle = open(file_name, "rb")
+        # compressed and uncompressed start of each block
+        if os.path.exists(gzi_name):
+            self.coffsets, self.uoffsets = self._read_gzi(gzi_name)
+        else:
+            self.coffsets, self.uoffsets = self._scan_blocks()
+        self._cached = (None, "")
+
+    def _read_gzi(self, gzi_name):
+        with open(gzi_name, "rb") as gzi:
+            count = struct.unpack("<Q", gzi.read(8))[0]
+            pairs = struct.unpack("<%dQ" % (2 * count), gzi.read(16 * count))
+        # the implicit first block at 0, 0 isn't stored
+        return [0] + list(pairs[0::2]), [0] + list(pairs[1::2])
+
+    def _scan_blocks(self):
+        coffsets = []
+        uoffsets = []
+        coffset = 0
+        uoffset = 0
+        size = os.path.getsize(self.file_name)
+        while coffset < size:
+            self._handle.seek(coffset)
+            header = self._handle.read(18)
+            if header[12:14] != "BC":
+                raise ValueError(self.file_name + " is not a bgzip file")
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            self._handle.seek(coffset + bsize - 4)
+            isize = struct.unpack("<I", self._handle.read(4))[0]
+            coffsets.append(coffset)
+            uoffsets.append(uoffset)
+            coffset += bsize
+            uoffset += isize
+        return coffsets, uoffsets
+
+    ## _block
+    #
+    #   uncompressed contents of block i (the last one read is cached)
+    def _block(self, i):
+        if self._cached[0] != i:
+            self._handle.seek(self.coffsets[i])
+            header = self._handle.read(18)
+            xlen = struct.unpack("<H", header[10:12])[0]
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            self._handle.seek(self.coffsets[i] + 12 + xlen)
+            data = self._handle.read(bsize - 12 - xlen - 8)
+            self._cached = (i, zlib.decompress(data, -15))
+        return self._cached[1]
+
+    def __getitem__(self, key):
+        start, end, step = key.indices(sys.maxint)
+        if end <= start:
+            return ""
+        first = bisect.bisect_right(self.uoffsets, start) - 1
+        pieces = []
+        i = first
+        while i < len(self.uoffsets) and self.uoffsets[i] < end:
+            pieces.append(self._block(i))
+            i += 1
+        return "".join(pieces)[start - self.uoffsets[first]:end - self.uoffsets[first]]
+
+    def close(self):
+        self._handle.close()
 
 ## fasta_iter
 #
 #   modified from code written by brentp and retrieved from https://www.biostars.org/p/710/ on May 5, 2015
-#   given a fasta file. yield tuples of header, sequence
+#   given a fasta file (an open file, or a file name to open with open_file).
+#   yield tuples of header, sequence
 def fasta_iter(fasta_name):
+    if isinstance(fasta_name, basestring):
+        fasta_name = open_file(fasta_name)
     # ditch the boolean (x[0]) and just keep the header or sequence since
     # we know they alternate.
     faiter = (x[1] for x in groupby(fasta_name, lambda line: line[0] == ">"))
@@ -20,71 +173,613 @@ def fasta_iter(fasta_name):
         seq = "".join(s.strip() for s in faiter.next())
         yield header, seq
 
+## IndexedFasta
+#
+#   random access to the sequences in a fasta file via a samtools-style
+#   .fai index (name, length, offset, bases per line, bytes per line).
+#   the index is reused if present and newer than the fasta, otherwise it
+#   is built with a single scan and written alongside the fasta (if possible).
+#   sequences are served straight from a memory map of the file, so only the
+#   requested slices are ever materialized. bgzip compressed fastas are read
+#   through a BgzfReader instead, as samtools faidx does (plain gzip
+#   doesn't allow random access, and raises ValueError).
+#   like samtools, a record's name is the first word of its header.
+class IndexedFasta(object):
+
+    def __init__(self, fasta_name, fai_name=None):
+        self.fasta_name = fasta_name
+        if fai_name is None:
+            fai_name = fasta_name + ".fai"
+        self.fai_name = fai_name
+        self.index = {} # name -> [length, offset, linebases, linewidth]
+        self.names = [] # record names in file order
+        self._handle = open(fasta_name, "rb")
+        if self._handle.read(2) == GZIP_MAGIC:
+            if not is_bgzf(fasta_name):
+                raise ValueError(fasta_name + " must be compressed with bgzip to be indexed")
+            self._map = BgzfReader(fasta_name)
+        elif os.path.getsize(fasta_name) > 0:
+            self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._map = ""
+        if (os.path.exists(fai_name) and
+            os.path.getmtime(fai_name) >= os.path.getmtime(fasta_name)):
+            self.read_fai()
+        else:
+            self.build_fai()
+            self.write_fai()
+
+    ## read_fai
+    #
+    #   load an existing .fai file
+    def read_fai(self):
+        with open(self.fai_name, "r") as fai:
+            for line in fai:
+                rec = line.rstrip("\n").split("\t")
+                self.index[rec[0]] = [int(x) for x in rec[1:5]]
+                self.names.append(rec[0])
+
+    ## build_fai
+    #
+    #   scan the fasta once, recording the geometry of each record.
+    #   raises ValueError if a record has lines of unequal width (other than
+    #   its last line), since such a file cannot be indexed.
+    def build_fai(self):
+        self.index = {}
+        self.names = []
+        name = None
+        offset = 0
+        with open_file(self.fasta_name) as fasta:
+            for line in fasta:
+                if line[0] == ">":
+                    name = line[1:].split()[0]
+                    rec = [0, offset + len(line), 0, 0]
+                    self.index[name] = rec
+                    self.names.append(name)
+                    short = False
+                elif name is not None:
+                    bases = len(line.rstrip("\r\n"))
+                    if rec[2] == 0:
+                        rec[2] = bases
+                        rec[3] = len(line)
+                    elif bases and (short or bases > rec[2]):
+                        raise ValueError("Different line length in sequence " + name)
+                    # only the final line of a record may be shorter
+                    if bases < rec[2]:
+                        short = True
+                    rec[0] += bases
+                offset += len(line)
+
+    ## write_fai
+    #
+    #   write the index next to the fasta; if that location isn't writable the
+    #   index is simply kept in memory
+    def write_fai(self):
+        try:
+            with open(self.fai_name, "w") as fai:
+                for name in self.names:
+                    fai.write("\t".join([name] + [str(x) for x in self.index[name]]) + "\n")
+        except IOError:
+            pass
+
+    def keys(self):
+        return list(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        return FastaRecord(self, name)
+
+    ## length
+    #
+    #   number of bases in the named sequence
+    def length(self, name):
+        return self.index[name][0]
+
+    ## fetch
+    #
+    #   return bases start..end (1-based, inclusive, as in gff3 and samtools
+    #   faidx) of the named sequence. omitting start or end reads from the
+    #   beginning or to the end of the sequence; out of range coordinates are
+    #   clipped.
+    def fetch(self, name, start=None, end=None):
+        length, offset, linebases, linewidth = self.index[name]
+        if start is None or start < 1:
+            start = 1
+        if end is None or end > length:
+            end = length
+        if end < start:
+            return ""
+        first = start - 1
+        first = offset + (first // linebases) * linewidth + first % linebases
+        last = end - 1
+        last = offset + (last // linebases) * linewidth + last % linebases
+        chunk = self._map[first:last + 1]
+        if linewidth - linebases:
+            chunk = chunk.replace("\n", "").replace("\r", "")
+        return chunk
+
+    ## header
+    #
+    #   the whole header line of the named sequence, without the ">", as
+    #   fasta_iter gives it (the index only keeps its first word). read back
+    #   from the start of the sequence in growing steps.
+    def header(self, name):
+        end = self.index[name][1] - 1
+        back = 256
+        while True:
+            first = max(0, end - back)
+            chunk = self._map[first:end]
+            start = chunk.rfind("\n")
+            if start >= 0 or first == 0:
+                break
+            back *= 2
+        return chunk[start + 2:].strip()
+
+    ## _slice
+    #
+    #   0-based, end-exclusive form of fetch used by FastaRecord
+    def _slice(self, name, first, last):
+        return self.fetch(name, first + 1, last)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._handle.close()
+
+## FastaRecord
+#
+#   lightweight view of one record of an IndexedFasta: it only knows the
+#   record's geometry (offset, length, line width), and bytes are read from
+#   the memory map when it is sliced. supports len() and python-style
+#   slicing, so it can stand in for a sequence string, e.g.
+#   record[99:102] == fasta_iter's seq[99:102].
+class FastaRecord(object):
+
+    def __init__(self, fasta, name):
+        self.fasta = fasta
+        self.name = name
+        self.length, self.offset, self.linebases, self.linewidth = fasta.index[name]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            first, last, step = key.indices(self.length)
+            if step == 1:
+                return self.fasta._slice(self.name, first, last)
+            return self.fasta._slice(self.name, 0, self.length)[key]
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("sequence index out of range")
+        return self.fasta._slice(self.name, key, key + 1)
+
+    def __str__(self):
+        return self.fasta._slice(self.name, 0, self.length)
+
+    ## chunks
+    #
+    #   iterate over the sequence in pieces of (at most) size bases, so
+    #   whole-record scans never hold more than one piece in memory
+    def chunks(self, size=1048576):
+        for first in xrange(0, self.length, size):
+            yield self.fasta._slice(self.name, first, min(first + size, self.length))
+
+## fasta_view_iter
+#
+#   mmap-backed counterpart of fasta_iter. given a fasta file name (not an
+#   open file), yield tuples of name, FastaRecord without reading any
+#   sequence into memory.
+def fasta_view_iter(fasta_name):
+    fasta = IndexedFasta(fasta_name)
+    for name in fasta:
+        yield name, fasta[name]
+
+## PackedSeq
+#
+#   compact in-memory nucleotide sequence, after UCSC's .2bit format.
+#   A, C, G and T are packed four to a byte; runs of any other character
+#   (N gaps, IUPAC codes) are kept as [start, length, char] blocks, and runs
+#   of lowercase (soft-masked) bases as [start, length] masks, both in
+#   0-based coordinates. supports len(), python-style slicing and revcomp,
+#   and round-trips the original sequence exactly.
+_pack_tbl = string.maketrans("acgt" + "".join(chr(x) for x in xrange(256) if chr(x) not in "ACGTacgt"),
+                             "ACGT" + "A" * 248)
+_pack4 = {}
+_unpack4 = [None] * 256
+for _byte in xrange(256):
+    _quad = "".join("ACGT"[(_byte >> _shift) & 3] for _shift in (6, 4, 2, 0))
+    _pack4[_quad] = chr(_byte)
+    _unpack4[_byte] = _quad
+_quad_re = re.compile("....", re.S)
+_block_re = re.compile(r"([^ACGT])\1*")
+_mask_re = re.compile("[a-z]+")
+
+class PackedSeq(object):
+
+    def __init__(self, seq=""):
+        self.length = len(seq)
+        upper = seq.upper()
+        self.blocks = [[m.start(), m.end() - m.start(), m.group(1)]
+                        for m in _block_re.finditer(upper)]
+        self.masks = [[m.start(), m.end() - m.start()] for m in _mask_re.finditer(seq)]
+        clean = seq.translate(_pack_tbl) + "A" * (-self.length % 4)
+        self.bases = "".join(map(_pack4.__getitem__, _quad_re.findall(clean)))
+
+    ## from_parts
+    #
+    #   rebuild a PackedSeq from its stored parts (see load_packed)
+    @classmethod
+    def from_parts(cls, length, bases, blocks, masks):
+        packed = cls()
+        packed.length = length
+        packed.bases = bases
+        packed.blocks = blocks
+        packed.masks = masks
+        return packed
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            first, last, step = key.indices(self.length)
+            if step == 1:
+                return self._unpack(first, last)
+            return self._unpack(0, self.length)[key]
+        if key < 0:
+            key += self.length
+        if key < 0 or key >= self.length:
+            raise IndexError("sequence index out of range")
+        return self._unpack(key, key + 1)
+
+    def __str__(self):
+        return self._unpack(0, self.length)
+
+    ## revcomp
+    #
+    #   reverse complement of bases first..last (0-based, end-exclusive;
+    #   the whole sequence by default)
+    def revcomp(self, first=0, last=None):
+        if last is None:
+            last = self.length
+        return revcomp(self._unpack(first, last))
+
+    ## _unpack
+    #
+    #   decode bases first..last (0-based, end-exclusive), then restore the
+    #   non-ACGT blocks and soft-masking that overlap them
+    def _unpack(self, first, last):
+        if last <= first:
+            return ""
+        skip = first % 4
+        seq = "".join(map(_unpack4.__getitem__,
+                        bytearray(self.bases[first // 4:(last + 3) // 4])))
+        seq = seq[skip:skip + last - first]
+        seq = _overlay(seq, first, last, self.blocks, lambda run, n: run[2] * n)
+        return _overlay(seq, first, last, self.masks, lambda run, n: None)
+
+## _overlay
+#
+#   replace the parts of seq (covering first..last) that overlap the sorted
+#   runs; fill(run, n) gives n replacement characters, or None to lowercase
+def _overlay(seq, first, last, runs, fill):
+    lo = bisect.bisect_right(runs, [first]) - 1
+    if lo < 0 or runs[lo][0] + runs[lo][1] <= first:
+        lo += 1
+    if lo >= len(runs) or runs[lo][0] >= last:
+        return seq
+    pieces = []
+    pos = 0
+    for run in itertools.islice(runs, lo, None):
+        start = max(run[0], first) - first
+        if start >= last - first:
+            break
+        end = min(run[0] + run[1], last) - first
+        pieces.append(seq[pos:start])
+        replacement = fill(run, end - start)
+        if replacement is None:
+            replacement = seq[start:end].lower()
+        pieces.append(replacement)
+        pos = end
+    pieces.append(seq[pos:])
+    return "".join(pieces)
+
+## PackedGenome
+#
+#   named collection of PackedSeqs, with the same lookup methods as
+#   IndexedFasta (fetch, length, keys, [name]) so scripts can use either
+class PackedGenome(object):
+
+    def __init__(self):
+        self.seqs = {}
+        self.names = []
+
+    def add(self, name, packed):
+        if name not in self.seqs:
+            self.names.append(name)
+        self.seqs[name] = packed
+
+    def keys(self):
+        return list(self.names)
+
+    def __contains__(self, name):
+        return name in self.seqs
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, name):
+        return self.seqs[name]
+
+    def length(self, name):
+        return len(self.seqs[name])
+
+    ## fetch
+    #
+    #   bases start..end (1-based, inclusive), as for IndexedFasta.fetch
+    def fetch(self, name, start=None, end=None):
+        packed = self.seqs[name]
+        if start is None or start < 1:
+            start = 1
+        if end is None or end > len(packed):
+            end = len(packed)
+        return packed._unpack(start - 1, end)
+
+## save_packed / load_packed
+#
+#   write a PackedGenome to disk, and read it back. the file is a small
+#   header ("PKSQ", version, record count) followed by, for each record,
+#   its name, length, blocks, masks and packed bases; integers are
+#   little-endian.
+PACKED_MAGIC = "PKSQ"
+
+def save_packed(genome, file_name):
+    with open(file_name, "wb") as out:
+        out.write(PACKED_MAGIC + struct.pack("<II", 1, len(genome)))
+        for name in genome:
+            packed = genome[name]
+            out.write(struct.pack("<I", len(name)) + name)
+            out.write(struct.pack("<QI", packed.length, len(packed.blocks)))
+            out.write("".join(struct.pack("<QQc", *run) for run in packed.blocks))
+            out.write(struct.pack("<I", len(packed.masks)))
+            out.write("".join(struct.pack("<QQ", *run) for run in packed.masks))
+            out.write(packed.bases)
+
+def load_packed(file_name):
+    genome = PackedGenome()
+    with open(file_name, "rb") as infile:
+        if infile.read(4) != PACKED_MAGIC:
+            raise ValueError(file_name + " is not a packed sequence file")
+        version, count = struct.unpack("<II", infile.read(8))
+        for i in xrange(count):
+            name = infile.read(struct.unpack("<I", infile.read(4))[0])
+            length, nblocks = struct.unpack("<QI", infile.read(12))
+            blocks = [list(x) for x in _unpack_runs("<QQc", infile, nblocks)]
+            nmasks = struct.unpack("<I", infile.read(4))[0]
+            masks = [list(x) for x in _unpack_runs("<QQ", infile, nmasks)]
+            bases = infile.read((length + 3) // 4)
+            genome.add(name, PackedSeq.from_parts(length, bases, blocks, masks))
+    return genome
+
+def _unpack_runs(fmt, infile, count):
+    size = struct.calcsize(fmt)
+    data = infile.read(size * count)
+    return [struct.unpack(fmt, data[i:i + size]) for i in xrange(0, size * count, size)]
+
+## pack_fasta
+#
+#   pack every record of an open fasta file into a PackedGenome, keyed (like
+#   IndexedFasta) by the first word of the header
+def pack_fasta(fasta_name):
+    genome = PackedGenome()
+    for header, seq in fasta_iter(fasta_name):
+        genome.add(header.split()[0], PackedSeq(seq))
+    return genome
+
+## open_genome
+#
+#   open a genome for random access: a packed sequence file (see save_packed)
+#   is loaded into memory, anything else is treated as a fasta file and
+#   indexed with IndexedFasta
+def open_genome(file_name):
+    with open(file_name, "rb") as infile:
+        magic = infile.read(4)
+    if magic == PACKED_MAGIC:
+        return load_packed(file_name)
+    return IndexedFasta(file_name)
+
+## GENETIC_CODES
+#
+#   NCBI translation tables, keyed by table number. each string gives the
+#   residue for all 64 codons with bases in TCAG order (TTT, TTC, TTA, TTG,
+#   TCT, ...), i.e. the 'ncbieaa' lines of NCBI's gc.prt
+GENETIC_CODES = {
+    1: "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    2: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSS**VVVVAAAADDEEGGGG",
+    3: "FFLLSSSSYY**CCWWTTTTPPPPHHQQRRRRIIMMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    4: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    5: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSSSVVVVAAAADDEEGGGG",
+    6: "FFLLSSSSYYQQCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    9: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNNKSSSSVVVVAAAADDEEGGGG",
+    10: "FFLLSSSSYY**CCCWLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    11: "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    12: "FFLLSSSSYY**CC*WLLLSPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    13: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNKKSSGGVVVVAAAADDEEGGGG",
+    14: "FFLLSSSSYYY*CCWWLLLLPPPPHHQQRRRRIIIMTTTTNNNKSSSSVVVVAAAADDEEGGGG",
+    16: "FFLLSSSSYY*LCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    21: "FFLLSSSSYY**CCWWLLLLPPPPHHQQRRRRIIMMTTTTNNNKSSSSVVVVAAAADDEEGGGG",
+    22: "FFLLSS*SYY*LCC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    23: "FF*LSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG",
+    }
+
+## CodonTable
+#
+#   dict of codon -> residue that answers "X" for anything that isn't a
+#   recognized codon (N, IUPAC codes, gaps), so lookups never raise
+class CodonTable(dict):
+
+    def __missing__(self, codon):
+        return "X"
+
+_codon_tables = {}
+_codon_re = re.compile("...", re.S)
+
+## codon_table
+#
+#   build the CodonTable for an NCBI translation table once, and cache it.
+#   stop codons are written as "-", as dna2aa always has.
+def codon_table(code=1):
+    if code in _codon_tables:
+        return _codon_tables[code]
+    residues = iter(GENETIC_CODES[code].replace("*", "-"))
+    tbl = CodonTable()
+    for first in "TCAG":
+        for second in "TCAG":
+            for third in "TCAG":
+                tbl[first + second + third] = residues.next()
+    _codon_tables[code] = tbl
+    return tbl
+
 ## dna2aa
 #
-#   convert dna to amino acid using standard codon table
+#   convert dna to amino acid using the given NCBI translation table
+#   (standard code by default)
 #   translates all seqs as internal ORFs
 #   i.e. doesn't care about start codons, just does straight translations
-def dna2aa(seq):
-    tbl = {"ATT":"I", "ATC":"I", "ATA":"I", "CTT":"L", "CTC":"L", "CTA":"L", "CTG":"L",
-        "TTA":"L", "TTG":"L", "GTT":"V", "GTC":"V", "GTA":"V", "GTG":"V", "TTT":"F",
-        "TTC":"F", "ATG":"M", "TGT":"C", "TGC":"C", "GCT":"A", "GCC":"A", "GCA":"A",
-        "GCG":"A", "GGT":"G", "GGC":"G", "GGA":"G", "GGG":"G", "CCT":"P", "CCC":"P",
-        "CCA":"P", "CCG":"P", "ACT":"T", "ACC":"T", "ACA":"T", "ACG":"T", "TCT":"S",
-        "TCC":"S", "TCA":"S", "TCG":"S", "AGT":"S", "AGC":"S", "TAT":"Y", "TAC":"Y",
-        "TGG":"W", "CAA":"Q", "CAG":"Q", "AAT":"N", "AAC":"N", "CAT":"H", "CAC":"H",
-        "GAA":"E", "GAG":"E", "GAT":"D", "GAC":"D", "AAA":"K", "AAG":"K", "CGT":"R",
-        "CGC":"R", "CGA":"R", "CGG":"R", "AGA":"R", "AGG":"R", "TAA":"-", "TAG":"-",
-        "TGA":"-"}
-    j = 0 # for iteration
-    aa = ''
-    seq = seq.upper() # TODO handle masked sequences more elegantly
-    seql = len(seq)
-    if seql % 3 != 0:
-        seq = seq[0:(seql-seql%3)] #trim to multiple of 3, but should be already
-    seql = len(seq) #recalculate
-    for j in range(0,seql,3):
-        j += 1
-        if j == (seql-1):
-            codon = seq[j:]
-            try:
-                aa = aa + tbl[codon]
-            except:
-                aa = aa + "X"
-        else:
-            codon = seq[j-1:j+2]
-            try:
-                aa = aa + tbl[codon]
-            except:
-                aa = aa+"X"
-#   print codon
-    return aa
+#   the sequence is cut into codons in one pass by the regex engine and
+#   mapped through the cached table; trailing bases that don't make a
+#   complete codon are ignored
+def dna2aa(seq, code=1):
+    return _translate(seq.upper(), codon_table(code))
+
+def _translate(seq, tbl):
+    return "".join(map(tbl.__getitem__, _codon_re.findall(seq)))
 
 ## revcomp
 #
 #   reverse-complement a dna sequence
+#   IUPAC codes are complemented too, and case is preserved so soft-masked
+#   (lowercase) bases stay masked. characters without a complement are
+#   passed through unchanged.
+_revcomp_tbl = string.maketrans("TCGAURYSWKMBVDHN-*tcgauryswkmbvdhn",
+                                "AGCTAYRSWMKVBHDN-*agctayrswmkvbhdn")
+
 def revcomp(seq):
-    tbl = {"T":"A","C":"G","G":"C","A":"T","U":"A","R":"Y","Y":"R","S":"S","W":"W","K":"M",
-        "M":"K","B":"V","V":"B","D":"H","H":"D","N":"N","-":"-","*":"*"}
-    fwd = ''
-    seq = seq.upper() # TODO handle masked sequences more elegantly
-    for i in seq:
-        fwd += tbl[i]
-    return fwd[::-1]
+    return seq.translate(_revcomp_tbl)[::-1]
+
+## revcomp_many
+#
+#   reverse-complement a batch of sequences with the same table as revcomp.
+#   bytearrays are complemented and reversed in place (the same objects are
+#   returned), so large buffers aren't copied once per step; strings
+#   are returned as new reverse-complemented strings.
+def revcomp_many(seqs):
+    out = []
+    for seq in seqs:
+        if isinstance(seq, bytearray):
+            seq[:] = seq.translate(_revcomp_tbl)
+            seq.reverse()
+            out.append(seq)
+        else:
+            out.append(seq.translate(_revcomp_tbl)[::-1])
+    return out
 
 ## sixframe
 #
 #   perform naive 6-frame translation of an input DNA sequence
 #   i.e. translate through stop codons, no alternate starts
-def sixframe(seq):
-    one = dna2aa(seq)
-    two = dna2aa(seq[1:])
-    three = dna2aa(seq[2:])
-    none = dna2aa(revcomp(seq))
-    ntwo = dna2aa(revcomp(seq)[1:])
-    nthree = dna2aa(revcomp(seq)[2:])
-
-    return [one, two, three, none, ntwo, nthree]    
+#   code selects the NCBI translation table, as for dna2aa
+#   the sequence is upper-cased and reverse-complemented only once
+def sixframe(seq, code=1):
+    tbl = codon_table(code)
+    seq = seq.upper()
+    rev = revcomp(seq)
+    return [_translate(frame, tbl) for frame in
+            (seq, seq[1:], seq[2:], rev, rev[1:], rev[2:])]
+
+## sixframe_iter
+#
+#   six-frame translation of a long sequence (a string or a FastaRecord) in
+#   windows of about 'window' bases, so only one window of sequence and
+#   protein is in memory at a time. yields tuples of the window's 0-based
+#   start and the six translated fragments, ordered as for sixframe.
+#   each codon belongs to the window its first base falls in, so joining the
+#   forward fragments in the order yielded, and the reverse fragments in the
+#   opposite order, gives exactly sixframe(seq).
+def sixframe_iter(seq, code=1, window=1000000):
+    tbl = codon_table(code)
+    length = len(seq)
+    window = max(3, window - window % 3)
+    # reverse frames are phased from the 3' end of the whole sequence
+    phases = [(length - frame) % 3 for frame in (0, 1, 2)]
+    for offset in xrange(0, length, window):
+        end = min(length, offset + window + 2)
+        chunk = seq[offset:end].upper()
+        rev = revcomp(chunk)
+        frames = [_translate(chunk[frame:], tbl) for frame in (0, 1, 2)]
+        for phase in phases:
+            frames.append(_translate(rev[(end - phase) % 3:], tbl))
+        yield offset, frames
+
+## orf_iter
+#
+#   scan all six frames of a (possibly chromosome-scale) sequence for open
+#   reading frames, i.e. runs of at least min_codons codons without a stop.
+#   yields tuples of strand ("+" or "-"), frame (1-3, numbered as for
+#   sixframe), start and end, where start <= end are 1-based inclusive
+#   forward-strand coordinates of the run, not including the stop codon.
+#   works through sixframe_iter, so memory use is bounded by the window.
+def orf_iter(seq, code=1, min_codons=30, window=1000000):
+    length = len(seq)
+    window = max(3, window - window % 3)
+    labels = [("+", 1), ("+", 2), ("+", 3), ("-", 1), ("-", 2), ("-", 3)]
+    phases = [0, 1, 2] + [(length - frame) % 3 for frame in (0, 1, 2)]
+    opened = [None] * 6 # 0-based start of the run still open in each frame
+    closed = [None] * 6 # 0-based end of the last codon seen in each frame
+    for offset, frames in sixframe_iter(seq, code, window):
+        end = min(length, offset + window + 2)
+        for idx in xrange(6):
+            aa = frames[idx]
+            if not aa:
+                continue
+            if idx < 3:
+                first = offset + phases[idx]
+            else:
+                # put reverse fragments in forward order to scan them the same way
+                aa = aa[::-1]
+                first = end - (end - phases[idx]) % 3 - 3 * len(aa)
+            pos = 0
+            while True:
+                stop = aa.find("-", pos)
+                if stop < 0:
+                    break
+                if opened[idx] is None and stop > pos:
+                    opened[idx] = first + 3 * pos
+                if opened[idx] is not None:
+                    last = first + 3 * stop - 1
+                    if last - opened[idx] + 1 >= 3 * min_codons:
+                        yield labels[idx] + (opened[idx] + 1, last + 1)
+                    opened[idx] = None
+                pos = stop + 1
+            if opened[idx] is None and pos < len(aa):
+                opened[idx] = first + 3 * pos
+            closed[idx] = first + 3 * len(aa) - 1
+    for idx in xrange(6):
+        if opened[idx] is not None and closed[idx] - opened[idx] + 1 >= 3 * min_codons:
+            yield labels[idx] + (opened[idx] + 1, closed[idx] + 1)
 
 ## trimpep
 #
@@ -0,0 +1,99 @@
+"""Functions to load tabular BLAST alignments (-outfmt 6 or 7)
+
+Hit: one alignment line, with its numeric columns converted
+hit_iter: iterate over the Hits in a tabular alignment file
+best_hits: the first (best-ranked) Hit for each query, read through a
+    small on-disk file of those lines so later runs skip the full file
+describe: trim a SwissProt-style description at a break string
+
+"""
+
+import os
+
+from fastatools import open_file
+
+# -outfmt "6 std stitle qcovs", the columns the MAKER annotation scripts expect
+DEFAULT_FIELDS = ("qseqid sseqid pident length mismatch gapopen qstart qend "
+                  "sstart send evalue bitscore stitle qcovs").split()
+
+# columns stored as numbers; anything else is kept as a string
+NUMERIC_FIELDS = {"pident": float, "length": int, "mismatch": int,
+                  "gapopen": int, "qstart": int, "qend": int, "sstart": int,
+                  "send": int, "evalue": float, "bitscore": float,
+                  "qcovs": float, "qcovhsp": float, "ppos": float,
+                  "nident": int, "positive": int, "gaps": int,
+                  "qlen": int, "slen": int}
+
+class Hit(object):
+
+    """Custom class to hold one tabular alignment line.
+
+    Each column is stored as an attribute named for its field in
+    'fields' (BLAST's -outfmt names), with the fields listed in
+    NUMERIC_FIELDS converted to int or float. The original line is
+    kept in 'raw'.
+
+    """
+
+    def __init__(self,line,fields=DEFAULT_FIELDS):
+        self.raw = line
+        for name,value in zip(fields,line.rstrip("\n").split("\t")):
+            if name in NUMERIC_FIELDS:
+                value = NUMERIC_FIELDS[name](value)
+            setattr(self,name,value)
+
+
+def hit_iter(aln,fields=DEFAULT_FIELDS):
+    """Yield a Hit for each alignment line, skipping outfmt 7 comments"""
+    with open_file(aln) as blast:
+        for line in blast:
+            if line[0] == "#" or not line.strip():
+                continue
+            yield Hit(line,fields)
+
+
+def best_hits(aln,fields=DEFAULT_FIELDS):
+    """Return a dict of query ID -> Hit for each query's first alignment.
+
+    BLAST lists each query's hits best first, so the first line seen
+    for a query is kept and the rest are ignored. Those lines are
+    copied to aln + '.best', which is read instead of the alignment
+    file on later calls as long as it is newer. If it can't be
+    written, the alignment file is simply read each time.
+
+    """
+    best_name = aln + ".best"
+    if (os.path.isfile(best_name) and
+        os.path.getmtime(best_name) >= os.path.getmtime(aln)):
+        return dict((hit.qseqid,hit) for hit in hit_iter(best_name,fields))
+
+    hits = {}
+    order = []
+    for hit in hit_iter(aln,fields):
+        if hit.qseqid not in hits:
+            hits[hit.qseqid] = hit
+            order.append(hit.qseqid)
+    try:
+        with open(best_name,"w") as outfile:
+            for query in order:
+                outfile.write(hits[query].raw.rstrip("\n") + "\n")
+    except IOError:
+        pass
+    return hits
+
+
+def describe(title,brk="OS=",sep=" "):
+    """Return the words of a description before the first one containing brk.
+
+    e.g. 'Protein kinase X OS=Homo sapiens GN=X' -> 'Protein kinase X'
+    Words are rejoined with sep.
+
+    """
+    words = []
+    for word in title.split(" "):
+        if brk in word:
+            break
+        words.append(word)
+    return sep.join(words)
+
+### EOF ###
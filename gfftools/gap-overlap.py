@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# usage: gap-overlap.py genes.gff genome.fa > gap-overlaps.tsv
+
+import re
+import sys
+from itertools import groupby
+
+import argparse
+
+from fastatools import open_genome
+import gfftools
+
+############
+# parse arguments
+
+desc = "".join(["Report exons and CDS segments that overlap runs of N in the genome",
+    " (e.g. gaps that gap2gff.py would list, or bases removed by redactor.py).",
+    " Gaps are found directly in the FASTA, one scaffold at a time, and each",
+    " feature is looked up in an index of its scaffold's gaps, so no intermediate",
+    " files are needed and the gff is read once. Output is tab-separated:",
+    " seqid, type, ID, Parent, start, end, gap start, gap end, bases in the gap."])
+
+parser = argparse.ArgumentParser(description=desc)
+
+parser.add_argument('gff', action='store', help='MAKER2 gff file')
+parser.add_argument('fasta', action='store',
+    help='FASTA file (or pack-fasta.py packed file) of the annotated scaffolds')
+parser.add_argument('--types', '-t', action='store', help='Comma-separated feature types to check [exon,CDS]', default='exon,CDS')
+parser.add_argument('--min_gap', '-m', action='store', type=int, help='Ignore runs of N shorter than this [1]', default=1)
+parser.add_argument('--outfile', '-o', action='store', help='Output file [stdout]')
+parser.add_argument('--threads', '-T', action='store', type=int, default=1,
+    help='Threads to decompress a gzip/bgzip gff with, if pigz or bgzip is installed [1]')
+
+args = parser.parse_args()
+
+TYPES = set(args.types.split(","))
+WINDOW = 1048576
+
+## scaffold_gaps
+#
+#   yield (start, end), 1-based and inclusive, for each run of N (or n) of at
+#   least min_gap bases in the named scaffold, reading it a window at a time.
+#   a run reaching the end of a window is held back in case the next window
+#   carries it on.
+gap_re = re.compile("[Nn]+")
+
+def scaffold_gaps(genome, seqid, min_gap=1):
+    length = genome.length(seqid)
+    held = None
+    for first in xrange(0, length, WINDOW):
+        window = genome.fetch(seqid, first + 1, min(first + WINDOW, length))
+        for run in gap_re.finditer(window):
+            start = first + run.start() + 1
+            end = first + run.end()
+            if held is not None:
+                if start == held[1] + 1:
+                    start = held[0]
+                elif held[1] - held[0] + 1 >= min_gap:
+                    yield held
+                held = None
+            if run.end() == len(window):
+                held = (start, end)
+            elif end - start + 1 >= min_gap:
+                yield (start, end)
+    if held is not None and held[1] - held[0] + 1 >= min_gap:
+        yield held
+
+## gap_index
+#
+#   index the gaps of one scaffold for overlap lookups
+def gap_index(genome, seqid, min_gap=1):
+    index = gfftools.RegionIndex()
+    for start, end in scaffold_gaps(genome, seqid, min_gap):
+        index.add_region(seqid, start, end, (start, end))
+    return index
+
+## feature_lines
+#
+#   yield the gff lines of the requested types, stopping at an embedded
+#   ##FASTA section and skipping anything without tabs
+def feature_lines(gff, threads=1):
+    with gfftools.open_file(gff, threads) as infile:
+        for line in infile:
+            if line[0] == "#":
+                if line.startswith("##FASTA"):
+                    break
+                continue
+            if "\t" not in line:
+                continue
+            if line.split("\t", 3)[2] in TYPES:
+                yield line
+
+###################
+# MAIN
+
+genome = open_genome(args.fasta)
+outfile = open(args.outfile, "w") if args.outfile else sys.stdout
+outfile.write("#seqid\ttype\tID\tParent\tstart\tend\tgap_start\tgap_end\toverlap\n")
+
+missing = set()
+# lines for a scaffold are usually together, so its gaps are found once per
+#  run of lines; a scaffold that turns up again is simply scanned again
+for seqid, lines in groupby(feature_lines(args.gff, args.threads), key=lambda line: line.split("\t", 1)[0]):
+    if seqid not in genome:
+        missing.add(seqid)
+        continue
+    gaps = gap_index(genome, seqid, args.min_gap)
+    for line in lines:
+        feature = gfftools.GFF(line, lazy=True)
+        for start, end in gaps.overlap(seqid, feature.istart, feature.iend):
+            outfile.write("\t".join([seqid, feature.type, feature.id,
+                                     ",".join(feature.parent), feature.start,
+                                     feature.end, str(start), str(end),
+                                     str(min(end, feature.iend) - max(start, feature.istart) + 1)])
+                          + "\n")
+
+if outfile is not sys.stdout:
+    outfile.close()
+if missing:
+    sys.stderr.write("Scaffolds in the gff but not the fasta: " +
+                     ", ".join(sorted(missing)) + "\n")
+
+### EOF ###
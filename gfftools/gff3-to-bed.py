@@ -3,111 +3,228 @@
 # quick and dirty gff3 (maker-style post- sort-gff.py) to bed file converter
 
 import sys
-import re
 
-import gfftools
-
-# n.b. s.argv[0] == script name
-gff=sys.argv[1]
+import argparse
 
-# dicts to hold the exon and cds records
-edic={}
-cdic={}
+import gfftools
 
-with open(gff,"r") as infile:
-    for line in infile:
-        if line[0] != "#":
-
-            rec = gfftools.GFF(line)
-
-            if rec.type == "mRNA" or rec.type == "ncRNA":
-                mid=rec.id
-                fstart=int(rec.start)-1 
-                fend=int(rec.end)-1
-                edic[mid]=[rec.seqid,fstart,fend,mid,0,rec.strand,fstart,fend,[255,0,0]]
-#                if rec.type != "ncRNA":
-#                    cdic[mid]=[rec.seqid,fstart,fend,mid,0,rec.strand,fstart,fend,[0,0,255]]
-            elif rec.type == "exon":
-                mid=re.sub(":exon","",rec.id)
-                fstart=int(rec.start)-1-edic[mid][1]
-                fend=int(rec.end)-1-edic[mid][1]
-                flen=fend-int(fstart)+1
-                if len(edic[mid]) == 9:
-                    edic[mid].append(1)
-                    edic[mid].append([flen])
-                    edic[mid].append([fstart])
-                else:
-                    edic[mid][9]+=1
-                    edic[mid][10].append(flen)
-                    edic[mid][11].append(fstart)
-            elif rec.type == "CDS":
-                mid=re.sub(":cds","",rec.id)
-                fstart=int(rec.start)-1-cdic[mid][1]
-                fend=int(rec.end)-1-cdic[mid][1]
-                flen=fend-int(fstart)+1
-                if len(cdic[mid]) == 9:
-                    cdic[mid][6]=int(rec.start)-1
-                    cdic[mid][7]=int(rec.start)-1
-                    cdic[mid].append(1)
-                    cdic[mid].append([flen])
-                    cdic[mid].append([fstart])
-                else:
-                    cdic[mid][9]+=1
-                    cdic[mid][10].append(flen)
-                    cdic[mid][11].append(fstart)
-
-
-for exon in edic:
-    # derive bed file name
-    bed = re.sub(".gff","_"+str(edic[exon][3])+"_exon.bed",gff)
-
-    with open(bed,"w") as outfile:
-        outfile.write('track name="'+str(edic[exon][3])+' exon"'+' description="'+str(edic[exon][3])+'"'+' itemRgb="On"'+'\n')
-
-        for rec in edic[exon][0:8]:
-            outfile.write(str(rec)+"\t")
-
-        for i in edic[exon][8]:
-            outfile.write(str(i)+",")
+############
+# parse arguments
+
+desc = "".join(["Convert MAKER-style gff3 transcripts (mRNA and ncRNA) to BED12.",
+    " Each transcript is one BED12 record: its exons are the blocks and its CDS",
+    " span sets thickStart/thickEnd (both at chromStart if it has no CDS).",
+    " By default each transcript gets its own .bed file; with --outfile every",
+    " record goes to one BED12 file instead. Either way, in a gff sorted by",
+    " position, each transcript is written as soon as a line starts past its end,",
+    " so only the transcripts overlapping the current line are held in memory."])
+
+parser = argparse.ArgumentParser(description=desc)
+
+parser.add_argument('gff', action='store', help='MAKER2 gff file')
+parser.add_argument('--outfile', '-o', action='store',
+    help='Write all records to this one BED12 file instead of a file per transcript')
+parser.add_argument('--sort', '-s', action='store_true',
+    help='With --outfile, sort records by seqid (byte order) then start, as'
+         ' bedToBigBed expects, and leave out the track line.'
+         ' The sorted lines are held until the end of the run')
+parser.add_argument('--index', '-i', action='store_true',
+    help='With --outfile, also write <outfile>.idx, a linear index of the byte'
+         ' offset of the first record touching each 16 kb window. Implies --sort')
+parser.add_argument('--threads', '-T', action='store', type=int, default=1,
+    help='Threads to decompress a gzip/bgzip gff with, if pigz or bgzip is installed [1]')
+
+args = parser.parse_args()
+
+if (args.sort or args.index) and not args.outfile:
+    parser.error("--sort and --index need --outfile")
+if args.index:
+    args.sort = True
+
+RGB = "255,0,0"
+# window size of the linear index, as in tabix
+INDEX_SHIFT = 14
+
+## bed_line
+#
+#   render one BED12 line. blocks is a list of (start, end) 1-based inclusive
+#   segments; chromStart/chromEnd are 0-based half-open, block starts are
+#   relative to chromStart.
+def bed_line(seqid, start, end, name, strand, thick_start, thick_end, rgb, blocks):
+    blocks = sorted(blocks)
+    sizes = "".join(str(e - s + 1) + "," for s, e in blocks)
+    starts = "".join(str(s - start) + "," for s, e in blocks)
+    return "\t".join([seqid, str(start - 1), str(end), name, "0", strand,
+                      str(thick_start - 1), str(thick_end), rgb,
+                      str(len(blocks)), sizes, starts]) + "\n"
+
+## transcript_line
+#
+#   render a finished transcript, record = [feature, exons, cds], as one BED12
+#   line. the exons are the blocks and the CDS span is the thick part; a
+#   transcript with no CDS gets an empty thick part at chromStart, the usual
+#   BED mark for non-coding.
+def transcript_line(record):
+    rna, exons, cds = record
+    if not exons:
+        exons = [(rna.istart, rna.iend)]
+    if cds:
+        thick_start, thick_end = min(s for s, e in cds), max(e for s, e in cds)
+    else:
+        thick_start, thick_end = rna.istart, rna.istart - 1
+    return bed_line(rna.seqid, rna.istart, rna.iend, rna.id, rna.strand,
+                    thick_start, thick_end, RGB, exons)
+
+## PerTranscript
+#
+#   the original output: one bed file per transcript, named after the gff and
+#   the transcript ID, each with its own track line
+class PerTranscript(object):
+
+    def __init__(self, gff):
+        self.gff = gff
+
+    def write(self, record):
+        name = record[0].id
+        bed = gfftools.output_name(self.gff, "_" + name + ".bed")
+        with open(bed, "w") as outfile:
+            outfile.write('track name="' + name + '"' + ' description="' +
+                          name + '"' + ' itemRgb="On"' + '\n')
+            outfile.write(transcript_line(record))
+
+    def close(self):
+        pass
+
+## SingleBed
+#
+#   every record in one file. unsorted, lines are written as they come; sorted,
+#   each scaffold's lines are sorted when the scaffold changes and all of them
+#   are written in seqid order at the end. the linear index is built as the
+#   sorted lines are written, from their actual byte offsets.
+class SingleBed(object):
+
+    def __init__(self, file_name, track, sort=False, index=False):
+        self.outfile = open(file_name, "w")
+        self.file_name = file_name
+        self.sort = sort
+        self.index = index
+        self.scaffolds = {}
+        self.seqid = None
+        self.block = []
+        if not sort:
+            self.outfile.write('track name="' + track + '"' + ' description="' +
+                               track + '"' + ' itemRgb="On"' + '\n')
+
+    def write(self, record):
+        rna = record[0]
+        line = transcript_line(record)
+        if not self.sort:
+            self.outfile.write(line)
+            return
+        if rna.seqid != self.seqid:
+            self._close_block()
+            self.seqid = rna.seqid
+            self.block = self.scaffolds.pop(rna.seqid, [])
+        self.block.append((rna.istart - 1, rna.iend, line))
+
+    def _close_block(self):
+        if self.seqid is not None:
+            self.block.sort()
+            self.scaffolds[self.seqid] = self.block
+        self.block = []
+
+    def close(self):
+        if self.sort:
+            self._close_block()
+            windows = []
+            for seqid in sorted(self.scaffolds):
+                seen = {}
+                for start, end, line in self.scaffolds[seqid]:
+                    offset = self.outfile.tell()
+                    for window in xrange(start >> INDEX_SHIFT, ((end - 1) >> INDEX_SHIFT) + 1):
+                        if window not in seen:
+                            seen[window] = offset
+                    self.outfile.write(line)
+                windows.extend((seqid, window, seen[window]) for window in sorted(seen))
+                del self.scaffolds[seqid][:]
+            if self.index:
+                with open(self.file_name + ".idx", "w") as idx:
+                    idx.write("#seqid\twindow_start\toffset\n")
+                    for seqid, window, offset in windows:
+                        idx.write("%s\t%d\t%d\n" % (seqid, window << INDEX_SHIFT, offset))
+        self.outfile.close()
+
+###################
+# MAIN
+
+if args.outfile:
+    track = gfftools.output_name(args.gff.split("/")[-1], "")
+    writer = SingleBed(args.outfile, track, args.sort, args.index)
+else:
+    writer = PerTranscript(args.gff)
+
+# transcript ID -> [mRNA/ncRNA feature, exons, CDS segments]; exons and CDS are
+#  tied to their transcript by Parent, so they may come before or after it
+pending = {}
+seqid = None
+
+## spans
+#
+#   whether a transcript's exons, sorted, tile its own line from start to end
+#   without overlapping, as BED12 blocks must
+def spans(record):
+    rna, exons = record[0], sorted(record[1])
+    if not exons:
+        return True
+    if exons[0][0] != rna.istart or max(e for s, e in exons) != rna.iend:
+        return False
+    return all(exons[i][1] < exons[i + 1][0] for i in xrange(len(exons) - 1))
+
+## flush
+#
+#   write out every pending transcript whose own line has been seen and that
+#   ends before position 'before' (all of them, if it is None); in a sorted gff
+#   none of their exons or CDS can come later. exons or CDS still waiting on
+#   their transcript are kept (or reported, at the end).
+def flush(before=None, final=False):
+    ready = [mid for mid in pending if pending[mid][0] is not None and
+             (before is None or pending[mid][0].iend < before)]
+    for mid in sorted(ready, key=lambda mid: pending[mid][0].istart):
+        record = pending.pop(mid)
+        if spans(record):
+            writer.write(record)
         else:
-            outfile.write("\t")
+            sys.stderr.write("Exons of " + mid + " don't cover its mRNA or ncRNA"
+                             " line from end to end, skipped\n")
+    if final:
+        for mid in sorted(pending):
+            sys.stderr.write("No mRNA or ncRNA line for " + mid + ", skipped\n")
 
-        outfile.write(str(edic[exon][9])+"\t")
-        
-        for i in edic[exon][10]:
-            outfile.write(str(i)+",")
-        else:
-            outfile.write("\t")
+with gfftools.open_file(args.gff, args.threads) as infile:
+    for line in infile:
+        if line[0] == "#":
+            if line.startswith("##FASTA"):
+                break
+            continue
+        if not line.strip():
+            continue
+
+        rec = gfftools.GFF(line)
+
+        if rec.seqid != seqid:
+            flush()
+            seqid = rec.seqid
+        elif pending:
+            flush(rec.istart)
+
+        if rec.type == "mRNA" or rec.type == "ncRNA":
+            pending.setdefault(rec.id, [None, [], []])[0] = rec
+        elif rec.type == "exon" or rec.type == "CDS":
+            for mid in rec.parent:
+                record = pending.setdefault(mid, [None, [], []])
+                record[1 if rec.type == "exon" else 2].append((rec.istart, rec.iend))
+
+flush(final=True)
+writer.close()
 
-        for i in edic[exon][11]:
-            outfile.write(str(i)+",")
-        else:
-            outfile.write("\n")
-if len(cdic) > 0:
-    for cds in cdic:
-        # derive bed file name
-        bed = re.sub(".gff","_"+str(cdic[cds][3])+"_cds.bed",gff)
-
-        with open(bed,"w") as outfile:
-            outfile.write('track name="'+str(cdic[cds][3])+' CDS"'+' description="'+str(cdic[cds][3])+'"'+' itemRgb="On"'+'\n')
-
-            for rec in cdic[cds][0:8]:
-                outfile.write(str(rec)+"\t")
-
-            for i in cdic[cds][8]:
-                outfile.write(str(i)+",")
-            else:
-                outfile.write("\t")
-
-            outfile.write(str(cdic[cds][9])+"\t")
-            
-            for i in cdic[cds][10]:
-                outfile.write(str(i)+",")
-            else:
-                outfile.write("\t")
-
-            for i in cdic[cds][11]:
-                outfile.write(str(i)+",")
-            else:
-                outfile.write("\n")
 ### EOF ###
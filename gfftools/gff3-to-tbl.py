@@ -2,14 +2,21 @@
 
 # usage: gff3-to-tbl.py genes.gff genome.fa alignment.blastp first_locus_number
 
+import os
 import sys
 import re
 import copy
+import anydbm
+import cPickle
+import hashlib
+from itertools import imap
+from multiprocessing import Pool
 
 import argparse
 
-from fastatools import fasta_iter as f
+from fastatools import open_genome
 import gfftools
+import alntools
 
 ############
 # parse arguments
@@ -24,8 +31,9 @@ parser = argparse.ArgumentParser(description=desc)
 
 parser.add_argument('gff', action='store', help='MAKER2 gff file')
 parser.add_argument('fasta', action='store',
-    help='FASTA file of scaffolds annoated by MAKER2')
-parser.add_argument('aln', action='store', help='Tabular blastp alignment of MAKER2 proteins vs. SwissProt')
+    help='FASTA file (or pack-fasta.py packed file) of scaffolds annoated by MAKER2')
+parser.add_argument('aln', action='store',
+    help='Tabular blastp alignment (-outfmt "6 std stitle qcovs") of MAKER2 proteins vs. SwissProt')
 
 parser.add_argument('--locus_tag', '-t', action='store', help='NCBI-supplied locus tag prefix [AB205]', default="AB205")
 parser.add_argument('--locus_tag_start', '-s', action='store', help='Initial value to use for locus_tag generation [50]', default=50)
@@ -37,6 +45,20 @@ parser.add_argument('--ref_break', '-b', action='store', help='String to split r
 parser.add_argument('--prod_break', '-r', action='store', help='Field separator for product line [space]', default=' ')
 parser.add_argument('--prefix', '-p', action='store', help='Prefix to use for product name [similar to]', default='similar to')
 parser.add_argument('--unknown', '-u', action='store', help='Label to give proteins without an acceptable annotation [hypothetical protein]', default='hypothetical protein')
+parser.add_argument('--stream', action='store_true',
+    help=''.join(['Convert a few scaffolds at a time, keeping only those in memory.',
+    ' The gff must have each scaffold\'s lines together (e.g. sorted by seqid).',
+    ' Locus tags are numbered in file order, and notes naming genes on later',
+    ' scaffolds keep their gene IDs (fix them with repair-tbl-notes.py)']))
+parser.add_argument('--cache', action='store',
+    help=''.join(['dbm file of converted scaffolds to reuse between runs. A scaffold is read, fixed,',
+    ' checked and rendered again only if its gene lines, annotations or locus tags or the',
+    ' genome file changed (created if missing)']))
+parser.add_argument('--jobs', '-J', action='store', type=int, default=1,
+    help=''.join(['Number of processes to convert scaffolds with (intron fixes, codon checks and',
+    ' tbl rendering); locus tags are still assigned in order [1]']))
+parser.add_argument('--threads', '-T', action='store', type=int, default=1,
+    help='Threads to decompress a gzip/bgzip gff with, if pigz or bgzip is installed [1]')
 
 args = parser.parse_args()
 
@@ -48,12 +70,21 @@ LOCUS = args.locus_tag
 LOCS = int(args.locus_tag_start)
 LOCW = int(args.tag_width)
 LOCJ = int(args.tag_jump)
-MIN_IDENT = int(args.min_ident)
-MIN_COV = int(args.min_cov)
+MIN_IDENT = float(args.min_ident)
+MIN_COV = float(args.min_cov)
 BRK = args.ref_break
 SEPO = args.prod_break
 PRE = args.prefix
 UNK = args.unknown
+JOBS = args.jobs
+THREADS = args.threads
+
+# bump when the tbl rendering changes, so old --cache entries are ignored
+CACHE_VERSION = "2"
+# the only gff feature types the tbl is made from
+GENE_TYPES = frozenset(["gene","mRNA","ncRNA","exon","CDS"])
+# with --stream, scaffolds converted together per process
+STREAM_BATCH = 4
 
 ############
 # hard-coded declarations
@@ -62,237 +93,382 @@ UNK = args.unknown
 ISOALPHA=['A','B','C','D','E','F','G','H','I','J','K','L','M','N','O','P','Q','R','S',
             'T','U','V','W','X','Y','Z']
 
-#gffout=open(re.sub(".gff","-prepared.gff",gff),"w")
-tblout=open(re.sub(".gff","-prepared.tbl",gff),"w")
-lokey=open(re.sub(".gff","-locus_tag-conversion-key.tsv",gff),"w")
+#gffout=open(gfftools.output_name(gff,"-prepared.gff"),"w")
+tblout=open(gfftools.output_name(gff,"-prepared.tbl"),"w")
+lokey=open(gfftools.output_name(gff,"-locus_tag-conversion-key.tsv"),"w")
+introns=open(gfftools.output_name(gff,"-intron-corrections.tsv"),"w")
+introns.write("#seqid\ttranscript\ttype\tupstream\tdownstream\told_start\tnew_start\told_intron\tnew_intron\n")
 
 ###################
-# MAIN
-
-genes = {}
-# read in the entries from the gff file
-with open(gff,"r") as infile:
-    print "Reading the annotations"
-    for line in infile:
-        if line[0] == "#" or line[0] == "-":
-            continue
-
-        feature = gfftools.GFF(line)
-
-        if feature.type == "gene":
-            genes[feature.id] = gfftools.Gene(feature)
-
-        elif feature.type == "mRNA" or feature.type == "ncRNA":
-            # transcripts can only have one parent, so access it explicitly
-            genes[feature.parent[0]].add_transcript(feature)
-
-        elif feature.type == "exon":
-            if feature.name:
-                genes[feature.name].transcript[feature.parent[0]].add_exon(feature)
+# FUNCTIONS
+
+def scaffold_lines(gff):
+    """Yield (seqid, lines) for each run of gene, transcript, exon and CDS
+    lines on one scaffold, stopping at a ##FASTA section"""
+    seqid = None
+    lines = []
+    with gfftools.open_file(gff,THREADS) as infile:
+        for line in infile:
+            if line[0] == "#":
+                if line.startswith("##FASTA"):
+                    break
                 continue
-            for parent in feature.parent:
-                for gene in genes:
-                    if re.findall(genes[gene].id,parent):
-                        genes[gene].transcript[parent].add_exon(feature)
-
-        elif feature.type == "CDS":
-            if feature.name:
-                genes[feature.name].transcript[feature.parent[0]].add_exon(feature)
+            if line[0] == "-" or "\t" not in line:
                 continue
-            for parent in feature.parent:
-                for gene in genes:
-                    if re.findall(genes[gene].id,parent):
-                        genes[gene].transcript[parent].add_cds(feature)
-
-###################
-# adjust small intron boundaries (ncbi min intron length is 10 bp)
-# use steps of 3 to preserve frame
-#  this will effectively delete up to 4 amino acids per adjustment (max if intron len was 1)
-print "Checking intron lengths"
-for entry in genes:
-    for rec in genes[entry].transcript:
-#        print "Checking intron lengths in " + rec
-        for j in range(0,len(genes[entry].transcript[rec].exons)):
-            dist = 11
-            try:
-                dist = int(genes[entry].transcript[rec].exons[j+1].start) - int(genes[entry].transcript[rec].exons[j].end)
-#                print dist
-            except:
-                pass
-            while dist < 11: # if use 'while dist < 10:' then too-small introns remain...
-                print "Correcting intron length between " + rec + " exons " + str(j+1) + " and " + str(j+2)
-                genes[entry].transcript[rec].exons[j+1].start = str(int(
-                            genes[entry].transcript[rec].exons[j+1].start) + 3)
-                dist += 3
-        # adjust the corresponding CDS start too, if the CDS start == that exon's start!
-        for j in range(0,len(genes[entry].transcript[rec].cds)):
-            dist = 11
-            try:
-                dist = int(genes[entry].transcript[rec].cds[j+1].start) - int(genes[entry].transcript[rec].cds[j].end)
-#                print dist
-            except:
-                pass
-            while dist < 11: # if use 'while dist < 10:' then too-small introns remain...
-                print "Applying intron length correction between " + rec + " exons " + str(j+1) + " and " + str(j+2) + " to the CDS too"
-                genes[entry].transcript[rec].cds[j+1].start = str(int(
-                            genes[entry].transcript[rec].cds[j+1].start) + 3)
-                dist += 3
-
-###################
-# Collect annotations for each transcript
-aseen = set()
-annots = {}
-with open(aln,"r") as blast:
-    print "Loading the annotations"
-    for rec in blast:
-        thisaln = rec.split("\t")
-        if thisaln[0] not in aseen:
-            cov = thisaln[-1]
-            if thisaln[2] >= MIN_IDENT and cov >= MIN_COV:
-                thisannot = thisaln[-2].split(" ")
-                refnam = ''
-                for i in range(0,len(thisannot)):
-                    if i == 0 and len(re.findall(BRK,thisannot[i])) < 1:
-                        refnam += thisannot[i]
-                    elif i > 0 and len(re.findall(BRK,thisannot[i])) < 1:
-                        refnam += SEPO+thisannot[i]
-                    else:
-                        break
-                annots[thisaln[0]] = PRE + SEPO + refnam
-#            else:
-#                annots[thisaln[0]] = UNK
-            aseen.add(thisaln[0])
-
-####################
-# Add locus_tag to each gene and annotation to each transcript
-scaf_order = {}
-print "Ordering the predictions along the genomic scaffolds"
-for entry in genes:
-    this_gene = genes[entry]
-    if this_gene.gene.seqid not in scaf_order:
-        if this_gene.gene.strand == "-":
-            scaf_order[this_gene.gene.seqid] = [[this_gene.gene.id,this_gene.gene.end]]
-        else:
-            scaf_order[this_gene.gene.seqid] = [[this_gene.gene.id,this_gene.gene.start]]
-    else:
-        if this_gene.gene.strand == "-":
-            scaf_order[this_gene.gene.seqid].append([this_gene.gene.id,this_gene.gene.end])
-        else:
-            scaf_order[this_gene.gene.seqid].append([this_gene.gene.id,this_gene.gene.start])
-
-locflag = 0 # flag to indicate first instance of locus ID
-lokey_dict = {}
-print "Adding locus tags and applying functional annotations"
-for scaf in scaf_order:
-#    scaf_order[scaf].sort(key = lambda x: x[1])
-#    for entry in scaf_order[scaf]:
-    for entry in sorted(scaf_order[scaf],key = lambda x: int(x[1])):
-        gene_name = entry[0]
-        if locflag == 0:
-            nam = LOCUS + "_" + str(LOCS).zfill(LOCW)
-            locs = LOCS + LOCJ
-            locflag = 1
+            rec = line.split("\t",3)
+            if rec[2] not in GENE_TYPES:
+                continue
+            if rec[0] != seqid:
+                if lines:
+                    yield seqid, lines
+                seqid = rec[0]
+                lines = []
+            lines.append(line)
+    if lines:
+        yield seqid, lines
+
+
+def scan_genes(lines):
+    """Read just the gene and transcript lines of a scaffold, as gene ID ->
+    [position, {transcript ID: transcript GFF}]. Transcripts are attached
+    to their gene as GeneBuilder would, so the result matches the genes
+    convert_scaffold builds from the same lines."""
+    genes = {}
+    waiting = {}
+    for line in lines:
+        kind = line.split("\t",3)[2]
+        if kind == "gene":
+            feature = gfftools.GFF(line,lazy=True)
+            if feature.strand == "-":
+                genes[feature.id] = [feature.end,{}]
+            else:
+                genes[feature.id] = [feature.start,{}]
+            for transcript in waiting.pop(feature.id,[]):
+                genes[feature.id][1].setdefault(transcript.id,transcript)
+        elif kind == "mRNA" or kind == "ncRNA":
+            feature = gfftools.GFF(line,lazy=True)
+            # transcripts can only have one parent
+            if feature.parent[0] in genes:
+                genes[feature.parent[0]][1].setdefault(feature.id,feature)
+            else:
+                waiting.setdefault(feature.parent[0],[]).append(feature)
+    return genes
+
+
+def fix_introns(seqid,genes):
+    """Widen introns shorter than NCBI's minimum of 10 bp.
+
+    Shifts are in steps of 3 to preserve frame; this will effectively
+    delete up to 4 amino acids per adjustment (max if intron len was 1).
+    Returns the intron report lines for the changes.
+
+    """
+    report = []
+    for entry in genes:
+        for rec in genes[entry].transcript:
+            for change in genes[entry].transcript[rec].widen_introns():
+                kind,segment,old,new,intron = change
+                report.append("\t".join([seqid,rec,kind,str(segment),str(segment+1),
+                                         str(old),str(new),str(intron),
+                                         str(intron + new - old)]) + "\n")
+    return report
+
+
+def load_annots(aln):
+    """Collect the annotation for each transcript from its best alignment"""
+    annots = {}
+    for query, hit in alntools.best_hits(aln).iteritems():
+        if hit.pident >= MIN_IDENT and hit.qcovs >= MIN_COV:
+            annots[query] = PRE + SEPO + alntools.describe(hit.stitle,BRK,SEPO)
+#        else:
+#            annots[query] = UNK
+    return annots
+
+
+def order_genes(genes):
+    """Map each scaffold to a list of [gene ID, position] for its genes"""
+    scaf_order = {}
+    for entry in genes:
+        this_gene = genes[entry]
+        if this_gene.gene.seqid not in scaf_order:
+            if this_gene.gene.strand == "-":
+                scaf_order[this_gene.gene.seqid] = [[this_gene.gene.id,this_gene.gene.end]]
+            else:
+                scaf_order[this_gene.gene.seqid] = [[this_gene.gene.id,this_gene.gene.start]]
         else:
-            nam = LOCUS + "_" + str(locs).zfill(LOCW)
-            locs += LOCJ
-
-        genes[gene_name].gene.locus_tag = nam
+            if this_gene.gene.strand == "-":
+                scaf_order[this_gene.gene.seqid].append([this_gene.gene.id,this_gene.gene.end])
+            else:
+                scaf_order[this_gene.gene.seqid].append([this_gene.gene.id,this_gene.gene.start])
+    return scaf_order
+
+
+def tag_genes(genes,locs,annots,lokey_dict):
+    """Give locus_tags to one scaffold's genes (from scan_genes) and products
+    to their transcripts.
+
+    locs is the next locus number to hand out. Returns the one after the
+    last used, and the tags as (gene ID -> locus_tag, transcript ID ->
+    [locus_tag, product or None to keep the gff's, note]).
+
+    """
+    gene_tags = {}
+    transcript_tags = {}
+    for gene_name in sorted(genes,key = lambda x: int(genes[x][0])):
+        transcripts = genes[gene_name][1]
+        nam = LOCUS + "_" + str(locs).zfill(LOCW)
+        locs += LOCJ
+
+        gene_tags[gene_name] = nam
         lokey.write(gene_name + "\t" + nam + "\n")
         lokey_dict[gene_name] = nam
         # Add locus_tags to each gene's transcripts, with addition of isoform
         #  letter if needed
-        if len(genes[gene_name].transcript) == 1:
-            tr_id = genes[gene_name].transcript.keys()[0]
-#            genes[gene_name].transcript[tr_id].locus_tag = nam
-            genes[gene_name].transcript[tr_id].transcript.locus_tag = nam
-            lokey.write(tr_id + "\t" + nam + "\n")
-
-            if genes[gene_name].transcript[tr_id].transcript.type == "mRNA":
-                if tr_id in annots:
-#                    genes[gene_name].transcript[tr_id].product = annots[tr_id]
-                    genes[gene_name].transcript[tr_id].transcript.product = annots[tr_id]
-                else:
-#                    genes[gene_name].transcript[tr_id].product = UNK
-                    genes[gene_name].transcript[tr_id].transcript.product = UNK
-
-#            for exon in range(0,len(genes[gene_name].transcript[tr_id].exons)):
-#                genes[gene_name].transcript[tr_id].exons[exon].locus_tag = nam
-#            if genes[gene_name].transcript[tr_id].cds:
-#                for i in range(0,len(genes[gene_name].transcript[tr_id].cds)):
-#                    genes[gene_name].transcript[tr_id].cds[i].locus_tag = nam
+        if len(transcripts) == 1:
+            labels = {transcripts.keys()[0]: nam}
         else:
-            loc_iter = 0
-            for prod in sorted(genes[gene_name].transcript):
-#                genes[gene_name].transcript[prod].locus_tag = nam + ISOALPHA[loc_iter]
-                genes[gene_name].transcript[prod].transcript.locus_tag = nam + ISOALPHA[loc_iter]
-                lokey.write(prod + "\t" + nam + ISOALPHA[loc_iter] + "\n")
-
-                if genes[gene_name].transcript[prod].transcript.type == "mRNA":
-                    if prod in annots:
-#                        genes[gene_name].transcript[prod].product = annots[prod]
-                        genes[gene_name].transcript[prod].transcript.product = annots[prod]
-                    else:
-#                        genes[gene_name].transcript[prod].product = UNK
-                        genes[gene_name].transcript[prod].transcript.product = UNK
-
-#                for i in range(0,len(genes[gene_name].transcript[prod].exons)):
-#                    genes[gene_name].transcript[prod].exons[i].locus_tag = nam + ISOALPHA[loc_iter]
-#                if genes[gene_name].transcript[prod].cds:
-#                    for j in range(0,len(genes[gene_name].transcript[prod].cds)):
-#                        genes[gene_name].transcript[prod].cds[j].locus_tag = nam + ISOALPHA[loc_iter]
-                loc_iter += 1
-lokey.close()
+            labels = dict((prod,nam + ISOALPHA[i])
+                          for i,prod in enumerate(sorted(transcripts)))
+        for prod in sorted(labels):
+            lokey.write(prod + "\t" + labels[prod] + "\n")
+            product = None
+            if transcripts[prod].type == "mRNA":
+                product = annots.get(prod,UNK)
+            transcript_tags[prod] = [labels[prod],product,transcripts[prod].note]
+    return locs,(gene_tags,transcript_tags)
+
+
+def fix_notes(tags,lokey_dict):
+    """Swap gene IDs in notes about split features for their locus_tags"""
+    for prod in tags[1]:
+        if tags[1][prod][2]:
+            fixed_note = []
+            for i in tags[1][prod][2].split(" "):
+                if i in lokey_dict:
+                    fixed_note.append(lokey_dict[i])
+                else:
+                    fixed_note.append(re.sub("end_","end;",i))
+            tags[1][prod][2] = " ".join(fixed_note)
 
-###################
-#load genomic scaffolds
-genome = {}
-with open(fasta,"r") as file_object:
-    print "Loading genomic scaffolds"
-    for line in f(file_object):
-        genome[line[0]] = line[1]
 
-###################
-# output tbl lines
-#scafs = set()
-prev_scaf = ''
-# order genes by ID; hopefully this corresponds to their position on the scaffold
-print "Writing final .tbl file"
-for scaf in scaf_order:
-#    for entry in scaf_order[scaf]:
-    for entry in sorted(scaf_order[scaf], key=lambda x: int(x[1])):
+def scaffold_genome():
+    """The genome, opened once in each process (pool workers don't share
+    the parent's file handles)"""
+    if GENOME[0] != os.getpid():
+        GENOME[:] = [os.getpid(),open_genome(fasta)]
+    return GENOME[1]
+
+
+def render_scaffold(writer,scaf,order,genes,length):
+    """Write one scaffold's tbl records to writer (a gfftools.TblWriter): its
+    >Feature header, then its genes by position, each followed by its
+    transcripts sorted by name. Codons must have been checked and notes
+    fixed already."""
+    writer.write_header(scaf,length)
+    for entry in sorted(order, key=lambda x: int(x[1])):
         rec = entry[0]
-#        for rec in sorted(genes):
-#        if genes[rec].gene.seqid not in scafs:
-        if genes[rec].gene.seqid != prev_scaf:
-            tblout.write("".join([">Feature ",genes[rec].gene.seqid,"\n"]))
-            tblout.write("\t".join(["1",str(len(genome[genes[rec].gene.seqid])),
-                                            "REFERENCE\n"]))
-            tblout.write("\t".join(["\t\t\tPBARC","12345\n"]))
-#            scafs.add(genes[rec].gene.seqid)
-
-        tblout.write(str(genes[rec].print_gene()))
-        prev_scaf = genes[rec].gene.seqid
-
-        # sort each gene's transcripts by name
+        genes[rec].check_complete()
+        writer.write_gene(genes[rec])
         for prod in sorted(genes[rec].transcript.keys()):
             try:
-                # if there is a note about a split feature, fix it
-                if genes[rec].transcript[prod].transcript.note:
-                    this_note = genes[rec].transcript[prod].transcript.note.split(" ")
-                    fixed_note = []
-                    for i in this_note:
-                        if i in lokey_dict:
-                            fixed_note.append(lokey_dict[i])
-                        else:
-                            fixed_note.append(re.sub("end_","end;",i))
-                    genes[rec].transcript[prod].transcript.note = " ".join(fixed_note)
-                tblout.write(str(genes[rec].transcript[prod].print_transcript(
-                            product_type = genes[rec].transcript[prod].transcript.type,
-                            outform = 'tbl',sequence=genome[genes[rec].gene.seqid])))
+                writer.write_transcript(genes[rec].transcript[prod],
+                            product_type = genes[rec].transcript[prod].transcript.type)
             except:
                 print "Failed to write out " + str(genes[rec].transcript[prod].transcript.id)
 
-tblout.close
+
+def convert_scaffold(job):
+    """Build, fix, check and render one scaffold from its gff lines.
+
+    job is (seqid, lines, tags from tag_genes). Returns the tbl text, the
+    intron report lines, [duplicate exons, duplicate CDS, features with
+    no parent] and the IDs of those missing parents. Run in the pool workers with --jobs, so only text
+    goes back to the parent.
+
+    """
+    scaf,lines,(gene_tags,transcript_tags) = job
+    builder = gfftools.GeneBuilder()
+    for line in lines:
+        builder.add(gfftools.GFF(line))
+    genes = builder.genes
+
+    skipped = [0,0,sum(len(x) for x in builder.orphans.values())]
+    for gene_name in genes:
+        genes[gene_name].gene.locus_tag = gene_tags[gene_name]
+        for prod,transcript in genes[gene_name].transcript.iteritems():
+            tag,product,note = transcript_tags[prod]
+            transcript.transcript.locus_tag = tag
+            if product is not None:
+                transcript.transcript.product = product
+            transcript.transcript.note = note
+            skipped[0] += transcript.duplicate_exons
+            skipped[1] += transcript.duplicate_cds
+
+    # adjust small intron boundaries (ncbi min intron length is 10 bp)
+    report = fix_introns(scaf,genes)
+    # check start/stop codons, reading only those bases from the genome's
+    # index (or a packed genome, if given a file made by pack-fasta.py)
+    genome = scaffold_genome()
+    gfftools.check_codons((transcript for gene in genes.values()
+                           for transcript in gene.transcript.values()),genome)
+    writer = gfftools.TblWriter()
+    render_scaffold(writer,scaf,order_genes(genes).get(scaf,[]),genes,
+                    genome.length(scaf))
+    return writer.getvalue(),report,skipped,sorted(builder.orphans)
+
+
+def scaffold_key(job):
+    """Hash everything a scaffold's conversion depends on: its gff lines,
+    the tags handed to it and the genome file"""
+    scaf,lines,(gene_tags,transcript_tags) = job
+    parts = [CACHE_VERSION,GENOME_STAMP,scaf,repr(sorted(gene_tags.items())),
+             repr(sorted(transcript_tags.items()))]
+    return hashlib.md5("\0".join(parts + lines)).hexdigest()
+
+
+def convert(batch,totals):
+    """Convert a list of scaffold jobs and write them out in order.
+
+    Scaffolds whose key is in the cache are copied from it, without
+    being parsed; the rest go through convert_scaffold, in the pool if
+    there is one, and are added to the cache. The cache is only used
+    from this (the main) thread. totals (widened introns, duplicate
+    exons and CDS, features with no parent, missing parents) is updated.
+
+    """
+    keys = [None] * len(batch)
+    hits = set()
+    todo = []
+    for i,job in enumerate(batch):
+        if cache is not None:
+            keys[i] = scaffold_key(job)
+            if keys[i] in cache:
+                hits.add(i)
+                continue
+        todo.append(job)
+    if pool is not None and len(todo) > 1:
+        done = pool.imap(convert_scaffold,todo)
+    else:
+        done = imap(convert_scaffold,todo)
+
+    for i in xrange(len(batch)):
+        if i in hits:
+            result = cPickle.loads(cache[keys[i]])
+        else:
+            result = done.next()
+            if keys[i] is not None:
+                cache[keys[i]] = cPickle.dumps(result,2)
+        text,report,skipped,orphans = result
+        tblout.write(text)
+        introns.writelines(report)
+        totals[0] += len(report)
+        for j in xrange(3):
+            totals[j + 1] += skipped[j]
+        totals[4].extend(orphans)
+
+
+###################
+# MAIN
+
+cache = None
+if args.cache:
+    cache = anydbm.open(args.cache,"c")
+
+# [pid, genome] for scaffold_genome, and the genome file's size and mtime
+#  for the cache keys
+GENOME = [None,None]
+GENOME_STAMP = "%d:%d" % (os.path.getsize(fasta),int(os.path.getmtime(fasta)))
+
+# fork the workers before the gff is read into memory
+pool = None
+if JOBS > 1:
+    pool = Pool(JOBS)
+
+print "Loading the annotations"
+annots = load_annots(aln)
+
+lokey_dict = {}
+locs = LOCS
+# widened introns, duplicate exons, duplicate CDS, features with no parent,
+#  missing parents
+totals = [0,0,0,0,[]]
+
+if args.stream:
+    print "Converting the gff one scaffold at a time"
+    done = set()
+    batch = []
+    for scaf, lines in scaffold_lines(gff):
+        if scaf in done:
+            print ("The lines for " + scaf + " are not all together; "
+                   "sort the gff by seqid or run without --stream")
+            sys.exit(1)
+        done.add(scaf)
+
+        genes = scan_genes(lines)
+        if not genes:
+            continue
+        locs,tags = tag_genes(genes,locs,annots,lokey_dict)
+        fix_notes(tags,lokey_dict)
+        batch.append((scaf,lines,tags))
+        # a few scaffolds per worker at a time keeps memory bounded
+        if len(batch) >= STREAM_BATCH * JOBS:
+            convert(batch,totals)
+            batch = []
+    convert(batch,totals)
+    lokey.close()
+
+else:
+    # read in the gene lines from the gff file, by scaffold
+    print "Reading the annotations"
+    scaffolds = {}
+    # scaffolds are numbered in the order a dict of gene IDs, filled in file
+    #  order, lists them, as they always have been
+    gene_seqids = {}
+    for scaf, lines in scaffold_lines(gff):
+        scaffolds.setdefault(scaf,[]).extend(lines)
+        for line in lines:
+            if line.split("\t",3)[2] == "gene":
+                gene_seqids[gfftools.GFF(line,lazy=True).id] = scaf
+    scaf_order = {}
+    for gene_name in gene_seqids:
+        scaf = gene_seqids[gene_name]
+        if scaf not in scaf_order:
+            scaf_order[scaf] = scan_genes(scaffolds[scaf])
+
+    # Add locus_tag to each gene and annotation to each transcript
+    print "Adding locus tags and applying functional annotations"
+    batch = []
+    for scaf in scaf_order:
+        locs,tags = tag_genes(scaf_order[scaf],locs,annots,lokey_dict)
+        batch.append((scaf,scaffolds[scaf],tags))
+    lokey.close()
+    for scaf,lines,tags in batch:
+        fix_notes(tags,lokey_dict)
+
+    # fix introns, check codons and output tbl lines, a scaffold at a time
+    if pool is not None:
+        print "Writing final .tbl file with " + str(JOBS) + " processes"
+    else:
+        print "Writing final .tbl file"
+    convert(batch,totals)
+
+if pool is not None:
+    pool.close()
+    pool.join()
+
+if totals[1] or totals[2]:
+    print ("Skipped " + str(totals[1]) + " exons and " + str(totals[2]) +
+           " CDS segments that repeat a start already in their transcript. "
+           "Please check your input.")
+if totals[3]:
+    print ("Skipped " + str(totals[3]) + " features whose parent isn't in the gff: " +
+           ", ".join(sorted(set(totals[4]))))
+print ("Widened " + str(totals[0]) + " short introns; see " + introns.name)
+
+tblout.close()
+introns.close()
+if cache is not None:
+    cache.close()
 
 ###################
 # output (repaired) gff lines
@@ -8,11 +8,38 @@ Transcript: object to hold exons, cds, and info associated with a
     particular transcript. Includes methods to print exon and CDS
     segments, and check if terminal CDS segments have start/stop
     codons.
+check_codons: checks CDS start/stop codons in one sorted pass over a genome
+TblWriter: renders genes and transcripts to .tbl text through a buffer
+GeneBuilder: assembles GFF features into Gene objects as they're read
+output_name: names an output file after its input gff
+read_scaffolds: reads a gff (in parallel, in chunks split between
+    scaffolds) into one GeneBuilder per scaffold
+FeatureTable: columnar store of a whole annotation, from which GFF,
+    Gene and Transcript objects can be built on demand, and which can
+    be saved as a binary snapshot and reloaded without reparsing
+RegionIndex: per-scaffold sorted index of features for overlap,
+    containment and nearest-feature queries
 
 """
 
+import os
 import re
+import mmap
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from itertools import compress, imap
+from multiprocessing import Pool
+from operator import eq, ge, le
+from urllib import unquote
+
 import fastatools
+from fastatools import open_file
+
+# attributes that may hold several comma-separated values
+MULTI_VALUE_KEYS = frozenset(["Parent", "Alias", "Dbxref", "Ontology_term"])
 
 class GFF(object):
 
@@ -22,15 +49,35 @@ class GFF(object):
     attributes into their own objects. Initializes slots for certain
     optional attributes too.
 
+    Column 9 is split once into the attrs dict (key -> value), with
+    values URL-unescaped. Keys in MULTI_VALUE_KEYS map to a list of
+    values. start and end are kept as the original strings (they are
+    what gets printed, and may gain partial marks); istart and iend
+    hold them as ints.
+
+    With lazy=True only the first eight columns are split up front.
+    Each attribute slot (and istart, iend, attrs) is decoded the first
+    time it is read, looking up just that key in column 9, which suits
+    tools that filter on a couple of fields.
+
+    Pickled (e.g. to pass between processes), a feature is sent as its
+    raw line and rebuilt lazily, plus any slot no longer matching the
+    line, such as a start moved by Transcript.widen_introns.
+
     feature: a raw gff line (with tab chars, newline, etc.)
+    lazy: defer decoding column 9 until it is accessed [False]
     """
 
-    def __init__(self,feature):
+    __slots__ = ("raw", "seqid", "source", "type", "start", "end", "score",
+                 "strand", "offset", "attributes", "istart", "iend", "attrs",
+                 "id", "parent", "locus_tag", "product", "name", "note",
+                 "target", "prot_desc", "trailing")
+
+    def __init__(self,feature,lazy=False):
 
         self.raw = feature
 
         _rec = feature.strip("\n").split("\t")
-        _attr = _rec[8].split(";")
 
         self.seqid = _rec[0]
         self.source = _rec[1]
@@ -41,43 +88,147 @@ class GFF(object):
         self.strand = _rec[6]
         self.offset = _rec[7]
         self.attributes = _rec[8]
-        self.id = ""
-        self.parent = ""
-        self.locus_tag = ""
-        self.product = ""
-        self.name = ""
-        self.note = ""
+        if lazy:
+            return
+        self.istart = int(_rec[3])
+        self.iend = int(_rec[4])
+        self.attrs = parse_attributes(_rec[8])
+
+        _get = self.attrs.get
+        self.id = _get("ID","")
+        # some features have > 1 parent, sep by ","
+        self.parent = _get("Parent","")
+        self.locus_tag = _get("locus_tag","")
+        self.product = _get("product","")
+        self.name = _get("Name","")
+        self.note = _get("note","")
+        self.prot_desc = _get("prot_desc","")
         self.target = ""
-        self.prot_desc = ""
         self.trailing = ""
+        if "Target" in self.attrs:
+            _unspl = self.attrs["Target"].split(" ")
+            self.target = _unspl[0]
+            if len(_unspl) > 1:
+                self.trailing = _unspl[1:]
+
+    def __getattr__(self,name):
+        # only reached for slots left unset by lazy parsing
+        if name in _LAZY_KEYS:
+            value = find_attribute(self.attributes,_LAZY_KEYS[name])
+            if value is None:
+                value = ""
+        elif name == "istart":
+            value = int(self.start)
+        elif name == "iend":
+            value = int(self.end)
+        elif name == "attrs":
+            value = parse_attributes(self.attributes)
+        elif name in ("target","trailing"):
+            _unspl = (find_attribute(self.attributes,"Target") or "").split(" ")
+            self.target = _unspl[0]
+            self.trailing = _unspl[1:] if len(_unspl) > 1 else ""
+            return getattr(self,name)
+        else:
+            raise AttributeError(name)
+        setattr(self,name,value)
+        return value
+
+    def copy(self):
+        """Return a shallow copy of the feature, without reparsing it."""
+        new = GFF.__new__(GFF)
+        get = object.__getattribute__
+        for name in GFF.__slots__:
+            try:
+                setattr(new,name,get(self,name))
+            except AttributeError:
+                continue
+        return new
+
+    def __reduce__(self):
+        fresh = GFF(self.raw)
+        get = object.__getattribute__
+        changed = {}
+        for name in GFF.__slots__[1:]:
+            try:
+                value = get(self,name)
+            except AttributeError:
+                continue
+            if get(fresh,name) != value:
+                changed[name] = value
+        return (GFF,(self.raw,True),changed or None)
+
+    def __setstate__(self,state):
+        for name,value in state.iteritems():
+            setattr(self,name,value)
+
+
+# GFF slots that lazy parsing decodes from a single column 9 key
+_LAZY_KEYS = {"id": "ID", "parent": "Parent", "locus_tag": "locus_tag",
+              "product": "product", "name": "Name", "note": "note",
+              "prot_desc": "prot_desc"}
+
+def parse_attributes(column):
+    """Split a GFF3 column 9 into a dict.
+
+    Values are URL-unescaped; those of keys in MULTI_VALUE_KEYS are
+    split on commas (before unescaping, so escaped commas survive)
+    into lists.
+
+    """
+    attrs = {}
+    for entry in column.split(";"):
+        key, sep, value = entry.partition("=")
+        if not sep:
+            continue
+        key = key.strip()
+        attrs[key] = _decode_value(key,value)
+    return attrs
+
+
+def find_attribute(column, key):
+    """Decode a single attribute from a GFF3 column 9.
+
+    Only the requested key is located and decoded (as for
+    parse_attributes); returns None if it isn't present.
+
+    """
+    if column.startswith(key + "="):
+        first = len(key) + 1
+    else:
+        for prefix in (";" + key + "=", "; " + key + "="):
+            first = column.find(prefix)
+            if first >= 0:
+                first += len(prefix)
+                break
+        else:
+            return None
+    last = column.find(";",first)
+    if last < 0:
+        last = len(column)
+    return _decode_value(key,column[first:last])
+
+
+def _decode_value(key, value):
+    if key in MULTI_VALUE_KEYS:
+        return [unquote(x) if "%" in x else x for x in value.split(",")]
+    elif "%" in value:
+        return unquote(value)
+    return value
+
+def output_name(gff,suffix):
+    """Name an output file after a gff.
+
+    A trailing '.gz' is dropped first, then a final '.gff' or '.gff3'
+    is replaced with suffix (which is appended if there is neither),
+    e.g. output_name('genes.gff.gz','-prepared.tbl') gives
+    'genes-prepared.tbl'.
+
+    """
+    if gff.endswith(".gz"):
+        gff = gff[:-3]
+    name,count = re.subn(r"\.gff3?$",suffix,gff)
+    return name if count else gff + suffix
 
-        for entry in _attr:
-            if re.findall("ID=",entry):
-                self.id = re.sub("ID=","",entry)
-            elif re.findall("Parent=",entry):
-                # some features have > 1 parent, sep by ","
-                self.parent = re.sub("Parent=","",entry).split(",")
-            elif re.findall("product=",entry):
-                self.product = re.sub("product=","",entry)
-            elif re.findall("Name=",entry):
-                self.name = re.sub("Name=","",entry)
-            elif re.findall("note=",entry):
-                self.note = re.sub("note=","",entry)
-            elif re.findall("locus_tag=",entry):
-                self.locus_tag = re.sub("locus_tag=","",entry)
-            elif re.findall("prot_desc=",entry):
-                self.prot_desc = re.sub("prot_desc=","",entry)
-            elif re.findall("Target=",entry):
-                _unspl = re.sub("Target=","",entry).split(" ")
-                self.target = _unspl[0]
-                if len(_unspl) > 1:
-                    self.trailing = _unspl[1:]
-
-        _contents = [self.seqid, self.source, self.type, self.start, self.end,
-                        self.score, self.strand, self.offset, self.id, self.parent,
-                        self.product, self.name, self.note, self.target, self.trailing,
-                        self.locus_tag]
-        self.contents = [x for x in _contents if x]
 
 class Transcript(object):
 
@@ -85,54 +236,79 @@ class Transcript(object):
 
     Stores the exons and cds in lists by position. Note that if the
     feature is on the negative strand then they will need to be
-    printed out in reverse order.
+    printed out in reverse order. Segments repeating a start already
+    stored are skipped and tallied in duplicate_exons/duplicate_cds.
 
     Methods:
     add_exon
     add_cds
+    widen_introns
     check_start
     check_stop
     check_fiveprime_complete
     check_threeprime_complete
-    print_single_seg
-    print_internal_seg
-    print_first_seg
-    print_last_seg
+    check_complete
+    codon_windows
+    set_codons
     print_transcript
 
     """
 
     def add_exon(self,feature):
-        if len(self.exons) == 0:
-            self.exons.append(feature)
+        """Insert an exon in start order.
+
+        Exons with the same start as one already stored are dropped
+        and counted in duplicate_exons.
+
+        """
+        pos = bisect_left(self._exon_starts,feature.istart)
+        if pos < len(self._exon_starts) and self._exon_starts[pos] == feature.istart:
+            self.duplicate_exons += 1
         else:
-            # TODO currently only compares to final exon in list for redundancy
-            if int(feature.start) == int(self.exons[-1].start):
-                print ("There is already an exon with that start in "
-                        "this transcript. Please check your input.")
-            elif int(feature.start) > int(self.exons[-1].start):
-                self.exons.append(feature)
-            else:
-                for pos in range(0,len(self.exons)):
-                    if int(feature.start) < int(self.exons[pos].start):
-                        self.exons.insert(pos,feature)
-                        break
+            self._exon_starts.insert(pos,feature.istart)
+            self.exons.insert(pos,feature)
 
 
     def add_cds(self,feature):
-        if len(self.cds) == 0:
-            self.cds.append(feature)
+        """Insert a CDS segment in start order.
+
+        Segments with the same start as one already stored are dropped
+        and counted in duplicate_cds.
+
+        """
+        pos = bisect_left(self._cds_starts,feature.istart)
+        if pos < len(self._cds_starts) and self._cds_starts[pos] == feature.istart:
+            self.duplicate_cds += 1
         else:
-            if int(feature.start) == int(self.cds[-1].start):
-                print ("There is already a cds segment with that start in "
-                        "this transcript. Please check your input.")
-            elif int(feature.start) > int(self.cds[-1].start):
-                self.cds.append(feature)
-            else:
-                for pos in range(0,len(self.cds)):
-                    if int(feature.start) < int(self.cds[pos].start):
-                        self.cds.insert(pos,feature)
-                        break
+            self._cds_starts.insert(pos,feature.istart)
+            self.cds.insert(pos,feature)
+
+
+    def widen_introns(self,min_intron=10):
+        """Shift segment starts so no intron is shorter than min_intron.
+
+        Each gap between a segment's end and the next one's start is
+        checked once; a short one is closed by moving the downstream
+        start right by the smallest multiple of 3 that is enough, which
+        keeps the frame. Exons and CDS segments are handled separately.
+        Returns a list of (type, segment number, old start, new start,
+        old intron length) for each change, numbering the upstream
+        segment of the pair from 1.
+
+        """
+        changes = []
+        for kind,segments,starts in (("exon",self.exons,self._exon_starts),
+                                     ("CDS",self.cds,self._cds_starts)):
+            for j in xrange(1,len(segments)):
+                intron = segments[j].istart - segments[j-1].iend - 1
+                if intron < min_intron:
+                    shift = 3 * ((min_intron - intron + 2) // 3)
+                    changes.append((kind,j,segments[j].istart,
+                                    segments[j].istart + shift,intron))
+                    segments[j].istart += shift
+                    segments[j].start = str(segments[j].istart)
+                    starts[j] = segments[j].istart
+        return changes
 
 
     def check_start(self,sequence):
@@ -142,7 +318,8 @@ class Transcript(object):
 
         """
         starts = ['ATG']
-        if sequence[0:3] in starts:
+        # soft-masked (lowercase) bases still count
+        if sequence[0:3].upper() in starts:
             self.start_complete = True
 
 
@@ -153,7 +330,7 @@ class Transcript(object):
 
         """
         stops = ['TAA','TGA','TAG']
-        if sequence[-3:] in stops:
+        if sequence[-3:].upper() in stops:
             self.stop_complete = True
 
 
@@ -223,11 +400,12 @@ class Transcript(object):
             self.threeprime_checked = True
 
 
-    def print_single_seg(self,feature,product_type=None,outform=None):
-        """Print the only exon/CDS segment in a transcript.
+    def print_transcript(self,product_type=None,outform=None,sequence=None):
+        """Print a transcript with exons (and cds segments).
 
         product_type = 'mRNA' or 'ncRNA'
         outform = 'gff' or 'tbl'
+        sequence = genomic scaffold sequence (for CDS completeness assessment)
 
         """
         if outform is None:
@@ -235,335 +413,81 @@ class Transcript(object):
         if product_type is None:
             product_type = 'mRNA'
         if outform == 'gff':
-            return feature.raw
-        elif outform == 'tbl':
             outbuff = []
-            if feature.type == "exon":
-                if feature.strand == "-":
-                    if product_type == "mRNA":
-                        outbuff.append("\t".join([feature.end,feature.start,"mRNA"]))
-                    elif product_type == "ncRNA":
-                        outbuff.append("\t".join([feature.end,feature.start,"ncRNA"]))
-                if feature.strand == "+":
-                    if product_type == "mRNA":
-                        outbuff.append("\t".join([feature.start,feature.end,"mRNA"]))
-                    elif product_type == "ncRNA":
-                        outbuff.append("\t".join([feature.start,feature.end,"ncRNA"]))
-                if product_type == "ncRNA":
-                    outbuff.append("\t\t\tncRNA_class\tlncRNA")
-                if self.transcript.product:
-                    if re.findall("similar",self.transcript.product):
-                        if self.transcript.locus_tag:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.locus_tag]))
-                        else:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.parent[0]]))
-                    else:
-                        outbuff.append("\t".join(["\t\t\tproduct",self.transcript.product]))
-                if self.transcript.note:
-                    outbuff.append("\t".join(["\t\t\tnote",self.transcript.note]))
-                if product_type == "mRNA":
-                    if self.transcript.locus_tag:
-                        outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                                self.transcript.locus_tag]))
-                        outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                                self.transcript.locus_tag,"_mRNA"]))
-                    else:
-                        outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                                feature.parent[0]]))
-                        outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                                feature.parent[0],"_mRNA"]))
-            if feature.type == "CDS":
-                if feature.strand == "-":
-                    outbuff.append("\t".join([feature.end,feature.start,"CDS"]))
-                else:
-                    outbuff.append("\t".join([feature.start,feature.end,"CDS"]))
-
-                if self.transcript.product:
-                    if re.findall("similar",self.transcript.product):
-                        if self.transcript.locus_tag:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.locus_tag]))
-                            outbuff.append("\t".join(["\t\t\tprot_desc",self.transcript.product]))
-                        else:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.parent[0]]))
-                            outbuff.append("\t".join(["\t\t\tprot_desc",self.transcript.product]))
-                    else:
-                        outbuff.append("\t".join(["\t\t\tproduct",self.transcript.product]))
-                if self.transcript.note:
-                    outbuff.append("\t".join(["\t\t\tnote",self.transcript.note]))
-
-                outbuff.append("\t\t\tcodon_start\t1")
-                if self.transcript.locus_tag:
-                    outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                            self.transcript.locus_tag]))
-                    outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                            self.transcript.locus_tag,"_mRNA"]))
-                else:
-                    outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                            feature.parent[0]]))
-                    outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                            feature.parent[0],"_mRNA"]))
-            # append a final newline to the end of the feature
-#            outbuff[-1] = "".join([outbuff[-1],"\n"])
-            return "\n".join(outbuff)
-
+            outbuff.append(self.transcript.raw)
 
-    def print_internal_seg(self,feature,outform=None):
-        """Print a given exon/CDS line or segment.
+            for segment in self.exons:
+                outbuff.append(segment.raw)
 
-        Format = 'gff' or 'tbl'
+            if self.cds:
+                for segment in self.cds:
+                    outbuff.append(segment.raw)
 
-        """
-        if outform is None:
-            outform = 'tbl'
-        if outform == 'gff':
-            return feature.raw
+            return "".join(outbuff)
         elif outform == 'tbl':
-            outbuff = []
-            if feature.strand == "-":
-                outbuff.append("\t".join([feature.end,feature.start]))
-            else:
-                outbuff.append("\t".join([feature.start,feature.end]))
+            writer = TblWriter()
+            writer.write_transcript(self,product_type,sequence)
+            return writer.getvalue()
 
-            return "\n".join(outbuff)
 
-    def print_first_seg(self,feature,product_type=None,outform=None):
-        """Print the first exon/CDS line or segment.
+    def check_complete(self,sequence=None):
+        """Apply the partial marks for a tbl record.
 
-        product_type = 'mRNA' or 'ncRNA'
-        outform = 'gff' or 'tbl'
+        Checks 5'/3' completeness if that hasn't been done yet, and,
+        given the scaffold sequence, whether the CDS has start and stop
+        codons (skipped if check_codons already did so).
 
         """
-        if outform is None:
-            outform = 'tbl'
-        if product_type is None:
-            product_type = 'mRNA'
-        if outform == 'gff':
-            return feature.raw
-        elif outform == 'tbl':
-            outbuff = []
-            if feature.type == "exon":
-                if feature.strand == "-":
-                    if product_type == "mRNA":
-                        outbuff.append("\t".join([feature.end,feature.start,"mRNA"]))
-                    if product_type == "ncRNA":
-                        outbuff.append("\t".join([feature.end,feature.start,"ncRNA"]))
-                if feature.strand == "+":
-                    if product_type == "mRNA":
-                        outbuff.append("\t".join([feature.start,feature.end,"mRNA"]))
-                    if product_type == "ncRNA":
-                        outbuff.append("\t".join([feature.start,feature.end,"ncRNA"]))
-            elif feature.type == "CDS":
-                if feature.strand == "-":
-                    outbuff.append("\t".join([feature.end,feature.start,"CDS"]))
-                if feature.strand == "+":
-                    outbuff.append("\t".join([feature.start,feature.end,"CDS"]))
-
-            return "\n".join(outbuff)
-
-
-    def print_last_seg(self,feature,product_type=None,outform=None):
-        """Print the final exon/CDS line or segment.
+        # check if the transcript is complete, if it hasn't been checked already.
+        if not self.fiveprime_checked:
+            self.check_fiveprime_complete()
+        if not self.threeprime_checked:
+            self.check_threeprime_complete()
+        # check for start and stop codons, unless check_codons got them already
+        if self.cds and sequence and not self.codons_checked:
+            self.set_codons(*[sequence[first:last] for first,last in self.codon_windows()])
 
-        product_type = 'mRNA' or 'ncRNA'
-        outform = 'gff' or 'tbl'
 
-        """
-        if outform is None:
-            outform = 'tbl'
-        if product_type is None:
-            product_type = 'mRNA'
-        if outform == 'gff':
-            return feature.raw
-        elif outform == 'tbl':
-            outbuff = []
-            if feature.type == "exon":
-                if feature.strand == "-":
-                    outbuff.append("\t".join([feature.end,feature.start]))
-                if feature.strand == "+":
-                    outbuff.append("\t".join([feature.start,feature.end]))
-                if self.transcript.product:
-                    if re.findall("similar",self.transcript.product):
-                        if self.transcript.locus_tag:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.locus_tag]))
-                        else:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.parent[0]]))
-#                        outbuff.append("\t".join(["\t\t\tprot_desc",self.transcript.product]))
-                    else:
-                        outbuff.append("\t".join(["\t\t\tproduct",self.transcript.product]))
-                if self.transcript.note:
-                    outbuff.append("\t".join(["\t\t\tnote",self.transcript.note]))
-                if product_type == "mRNA":
-                    if self.transcript.locus_tag:
-                        outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                                self.transcript.locus_tag]))
-                        outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                                self.transcript.locus_tag,"_mRNA"]))
-                    else:
-                        outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                                feature.parent[0]]))
-                        outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                                feature.parent[0],"_mRNA"]))
-                if product_type == "ncRNA":
-                    outbuff.append("\t\t\tncRNA_class\tlncRNA")
-            elif feature.type == "CDS":
-                if feature.strand == "-":
-                    outbuff.append("\t".join([feature.end,feature.start]))
-                if feature.strand == "+":
-                    outbuff.append("\t".join([feature.start,feature.end]))
-                if self.transcript.product:
-                    if re.findall("similar",self.transcript.product):
-                        if self.transcript.locus_tag:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.locus_tag]))
-                            outbuff.append("\t".join(["\t\t\tprot_desc",self.transcript.product]))
-                        else:
-                            outbuff.append("\t".join(["\t\t\tproduct",self.transcript.parent[0]]))
-                            outbuff.append("\t".join(["\t\t\tprot_desc",self.transcript.product]))
-                    else:
-                        outbuff.append("\t".join(["\t\t\tproduct",self.transcript.product]))
-                if self.transcript.note:
-                    outbuff.append("\t".join(["\t\t\tnote",self.transcript.note]))
-
-                outbuff.append("\t\t\tcodon_start\t1")
-                if self.transcript.locus_tag:
-                    outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                            self.transcript.locus_tag]))
-                    outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                            self.transcript.locus_tag,"_mRNA"]))
-                else:
-                    outbuff.append("".join(["\t\t\tprotein_id\tgnl|BCGSC|",
-                                            feature.parent[0]]))
-                    outbuff.append("".join(["\t\t\ttranscript_id\tgnl|BCGSC|",
-                                            feature.parent[0],"_mRNA"]))
-            # append a final newline to the end of the feature
-#            outbuff[-1] = "".join([outbuff[-1],"\n"])
-            return "\n".join(outbuff)
-
-
-    def print_transcript(self,product_type=None,outform=None,sequence=None):
-        """Print a transcript with exons (and cds segments).
+    def codon_windows(self):
+        """Return the (start, stop) codon windows of the CDS.
 
-        product_type = 'mRNA' or 'ncRNA'
-        outform = 'gff' or 'tbl'
-        sequence = genomic scaffold sequence (for CDS completeness assessment)
+        Each is a 0-based, end-exclusive (first, last) pair on the
+        scaffold; on the negative strand the bases still need to be
+        reverse complemented (set_codons does this).
 
         """
-        if outform is None:
-            outform = 'tbl'
-        if product_type is None:
-            product_type = 'mRNA'
-        if outform == 'gff':
-            outbuff = []
-            outbuff.append(self.transcript.raw)
+        if self.strand == "-":
+            return ((self.cds[-1].iend - 3,self.cds[-1].iend),
+                    (self.cds[0].istart - 1,self.cds[0].istart + 2))
+        return ((self.cds[0].istart - 1,self.cds[0].istart + 2),
+                (self.cds[-1].iend - 3,self.cds[-1].iend))
 
-            for segment in self.exons:
-                outbuff.append(segment.raw)
 
-            if self.cds:
-                for segment in self.cds:
-                    outbuff.append(segment.raw)
+    def set_codons(self,start_codon,stop_codon):
+        """Record whether the CDS starts and stops with proper codons.
 
-            return "".join(outbuff)
-        elif outform == 'tbl':
-            # check if the transcript is complete, if it hasn't been checked already.
-            if not self.fiveprime_checked:
-                self.check_fiveprime_complete()
-            if not self.threeprime_checked:
-                self.check_threeprime_complete()
-            outbuff = []
-            if len(self.exons) == 1:
-                outbuff.append(self.print_single_seg(self.exons[0],product_type,outform))
-#                outbuff[-1] = "".join([outbuff[-1],"\n"])
-#                return "\n".join(outbuff)
-            if len(self.exons) > 1:
-                if self.strand == "-":
-                    if len(self.exons) == 2:
-                        outbuff.append(self.print_first_seg(self.exons[-1],product_type,
-                                        outform))
-                        outbuff.append(self.print_last_seg(self.exons[0],product_type,
-                                        outform))
-                    if len(self.exons) > 2:
-                        outbuff.append(self.print_first_seg(self.exons[-1],product_type,
-                                        outform))
-                        for segment in range(0,len(self.exons))[1:-1][::-1]:
-                           outbuff.append(self.print_internal_seg(self.exons[segment],
-                                            outform))
-                        else:
-                            outbuff.append(self.print_last_seg(self.exons[0],
-                                            product_type,outform))
-                if self.strand == "+":
-                    if len(self.exons) == 2:
-                        outbuff.append(self.print_first_seg(self.exons[0],product_type,
-                                        outform))
-                        outbuff.append(self.print_last_seg(self.exons[-1],product_type,
-                                        outform))
-                    if len(self.exons) > 2:
-                        outbuff.append(self.print_first_seg(self.exons[0],product_type,
-                                        outform))
-                        for segment in range(0,len(self.exons))[1:-1]:
-                            outbuff.append(self.print_internal_seg(self.exons[segment],
-                                            outform))
-                        else:
-                            outbuff.append(self.print_last_seg(self.exons[-1],
-                                            product_type,outform))
-            if self.cds:
-                # check for start and stop codons
-                if sequence:
-                    # do the checks if they haven't been done yet (assume if start
-                    #   unset then stop isn't either)
-                    # will also be re-checked if is incomplete... # TODO do check better
-                    if not self.start_complete and not self.stop_complete:
-                        if self.strand == "-":
-                            # correct for difference in 0-based Python and 1-based gff3
-                            self.check_start(fastatools.revcomp(sequence[int(self.cds[-1].end)-3:int(self.cds[-1].end)]))
-                            self.check_stop(fastatools.revcomp(sequence[int(self.cds[0].start)-1:int(self.cds[0].start)+2]))
-                            if not self.start_complete:
-                                self.cds[-1].end = "<" + self.cds[-1].end
-                            if not self.stop_complete:
-                                self.cds[0].start = ">" + self.cds[0].start
-                        if self.strand == "+":
-                            self.check_start(sequence[int(self.cds[0].start)-1:int(self.cds[0].start)+2])
-                            self.check_stop(sequence[int(self.cds[-1].end)-3:int(self.cds[-1].end)])
-                            if not self.start_complete:
-                                self.cds[0].start = "<" + self.cds[0].start
-                            if not self.stop_complete:
-                                self.cds[-1].end = ">" + self.cds[-1].end
-                if len(self.cds) == 1:
-                    outbuff.append(self.print_single_seg(self.cds[0],product_type,outform))
-                if len(self.cds) > 1:
-                    if self.strand == "-":
-                        if len(self.cds) == 2:
-                            outbuff.append(self.print_first_seg(self.cds[-1],
-                                            product_type,outform))
-                            outbuff.append(self.print_last_seg(self.cds[0],product_type,
-                                            outform))
-                        if len(self.cds) > 2:
-                            outbuff.append(self.print_first_seg(self.cds[-1],
-                                            product_type,outform))
-                            for segment in range(0,len(self.cds))[1:-1][::-1]:
-                                outbuff.append(self.print_internal_seg(self.cds[segment],
-                                                outform))
-                            else:
-                                outbuff.append(self.print_last_seg(self.cds[0],
-                                            product_type,outform))
-                    if self.strand == "+":
-                        if len(self.cds) == 2:
-                            outbuff.append(self.print_first_seg(self.cds[0],product_type,
-                                            outform))
-                            outbuff.append(self.print_last_seg(self.cds[-1],product_type,
-                                            outform))
-                        if len(self.cds) > 2:
-                            outbuff.append(self.print_first_seg(self.cds[0],product_type,
-                                            outform))
-                            for segment in range(0,len(self.cds))[1:-1]:
-                                outbuff.append(self.print_internal_seg(self.cds[segment],
-                                                outform))
-                            else:
-                                outbuff.append(self.print_last_seg(self.cds[-1],
-                                                product_type,outform))
-
-            # append a final newline to the end of the feature
-            outbuff[-1] = "".join([outbuff[-1],"\n"])
-            return "\n".join(outbuff)
+        Takes the bases from the codon_windows and marks the CDS partial
+        ('<' / '>') at whichever end lacks its codon. Only the first
+        call has any effect.
+
+        """
+        if self.codons_checked:
+            return
+        self.codons_checked = True
+        if self.strand == "-":
+            self.check_start(fastatools.revcomp(start_codon))
+            self.check_stop(fastatools.revcomp(stop_codon))
+            if not self.start_complete:
+                self.cds[-1].end = "<" + self.cds[-1].end
+            if not self.stop_complete:
+                self.cds[0].start = ">" + self.cds[0].start
+        if self.strand == "+":
+            self.check_start(start_codon)
+            self.check_stop(stop_codon)
+            if not self.start_complete:
+                self.cds[0].start = "<" + self.cds[0].start
+            if not self.stop_complete:
+                self.cds[-1].end = ">" + self.cds[-1].end
 
 
     def __init__(self,feature):
@@ -571,6 +495,11 @@ class Transcript(object):
         self.transcript = feature
         self.exons = []
         self.cds = []
+        # integer starts parallel to exons/cds, searched by add_exon/add_cds
+        self._exon_starts = []
+        self._cds_starts = []
+        self.duplicate_exons = 0
+        self.duplicate_cds = 0
         # five or three prime complete set to false if fails check
         self.fiveprime_complete = True
         self.fiveprime_checked = False
@@ -578,6 +507,7 @@ class Transcript(object):
         self.threeprime_checked = False
         self.start_complete = False
         self.stop_complete = False
+        self.codons_checked = False
 
 
 class Gene(object):
@@ -591,6 +521,7 @@ class Gene(object):
 
     Methods:
     add_transcript
+    check_complete
     print_gene
         
     """
@@ -619,93 +550,83 @@ class Gene(object):
         if outform == 'gff':
             return self.gene.raw
         elif outform == 'tbl':
-            # check gene completeness
-            # gene is incomplete if left and/or right-most transcript(s) incomplete
-            starts = []
-            stops = []
-            for i in self.transcript:
-                starts.append((int(self.transcript[i].transcript.start),
-                    self.transcript[i].transcript.id))
-                stops.append((int(self.transcript[i].transcript.end),
-                    self.transcript[i].transcript.id))
-            starts.sort(key = lambda x: x[0]) # smallest first
-            stops.sort(key = lambda x: x[0],reverse = True) # largest first
-            if self.gene.strand == "+":
-#                if self.transcript[starts[0][1]].cds:
-#                    if (int(re.sub("[<>]","",self.transcript[starts[0][1]].exons[0].start)) 
-#                        == int(re.sub("[<>]","",self.transcript[starts[0][1]].cds[0].start))):
-#                        self.gene.start = "<" + self.gene.start
-#                        self.fiveprime_complete = False
-#                        self.fiveprime_checked = True
-#                    if (int(re.sub("[<>]","",self.transcript[stops[0][1]].exons[-1].end))
-#                        == int(re.sub("[<>]","",self.transcript[stops[0][1]].cds[-1].end))):
-#                        self.gene.end = ">" + self.gene.end
-#                        self.threeprime_complete = False
-#                        self.threeprime_checked = True
-#                else:
-#                    self.fiveprime_complete = False
-#                    self.fiveprime_checked = True
-#                    self.threeprime_complete = False
-#                    self.threeprime_checked = True
-                if not self.transcript[starts[0][1]].fiveprime_checked:
-                    self.transcript[starts[0][1]].check_fiveprime_complete()
-                self.fiveprime_complete = self.transcript[starts[0][1]].fiveprime_complete
-                self.fiveprime_checked = True
-                if not self.transcript[stops[0][1]].threeprime_checked:
-                    self.transcript[stops[0][1]].check_threeprime_complete()
-                self.threeprime_complete = self.transcript[stops[0][1]].threeprime_complete
-                self.threeprime_checked = True
-                if not self.fiveprime_complete:
-                    self.gene.start = "<" + self.gene.start
-                if not self.threeprime_complete:
-                    self.gene.end = ">" + self.gene.end
-            if self.gene.strand == "-":
-#                if self.transcript[starts[0][1]].cds:
-#                    if (int(re.sub("[<>]","",self.transcript[starts[0][1]].exons[0].start)) 
-#                        == int(re.sub("[<>]","",self.transcript[starts[0][1]].cds[0].start))):
-#                        self.gene.start = ">" + self.gene.start
-#                        self.threeprime_complete = False
-#                        self.threeprime_checked = True
-#                    if (int(re.sub("[<>]","",self.transcript[stops[0][1]].exons[-1].end))
-#                        == int(re.sub("[<>]","",self.transcript[stops[0][1]].cds[-1].end))):
-#                        self.gene.end = "<" + self.gene.end
-#                        self.fiveprime_complete = False
-#                        self.fiveprime_checked = True
-#                else:
-#                    self.fiveprime_complete = False
-#                    self.fiveprime_checked = True
-#                    self.threeprime_complete = False
-#                    self.threeprime_checked = True
-                if not self.transcript[stops[0][1]].fiveprime_checked:
-                    self.transcript[stops[0][1]].check_fiveprime_complete()
-                self.fiveprime_complete = self.transcript[stops[0][1]].fiveprime_complete
-                self.fiveprime_checked = True
-                if not self.transcript[starts[0][1]].threeprime_checked:
-                    self.transcript[starts[0][1]].check_threeprime_complete()
-                self.threeprime_complete = self.transcript[starts[0][1]].threeprime_complete
-                self.threeprime_checked = True
-                if not self.fiveprime_complete:
-                    self.gene.end = "<" + self.gene.end
-                if not self.threeprime_complete:
-                    self.gene.start = ">" + self.gene.start
-
-            outbuff = []
-            if self.gene.strand == "-":
-                if self.gene.locus_tag:
-                    outbuff.append("".join([self.gene.end,"\t",self.gene.start,"\tgene\n",
-                                    "\t\t\tlocus_tag\t",self.gene.locus_tag,"\n"]))
-                else:
-                    outbuff.append("".join([self.gene.end,"\t",self.gene.start,"\tgene\n",
-                                    "\t\t\tlocus_tag\t",self.gene.id,"\n"]))
-            if self.gene.strand == "+":
-                if self.gene.locus_tag:
-                    outbuff.append("".join([self.gene.start,"\t",self.gene.end,"\tgene\n",
-                                    "\t\t\tlocus_tag\t",self.gene.locus_tag,"\n"]))
-                else:
-                    outbuff.append("".join([self.gene.start,"\t",self.gene.end,"\tgene\n",
-                                    "\t\t\tlocus_tag\t",self.gene.id,"\n"]))
-
-            return "\n".join(outbuff)
+            self.check_complete()
+            writer = TblWriter()
+            writer.write_gene(self)
+            return writer.getvalue()
+
+
+    def check_complete(self):
+        """Mark the gene partial where its outermost transcripts are."""
+        # check gene completeness
+        # gene is incomplete if left and/or right-most transcript(s) incomplete
+        starts = []
+        stops = []
+        for i in self.transcript:
+            starts.append((int(self.transcript[i].transcript.start),
+                self.transcript[i].transcript.id))
+            stops.append((int(self.transcript[i].transcript.end),
+                self.transcript[i].transcript.id))
+        starts.sort(key = lambda x: x[0]) # smallest first
+        stops.sort(key = lambda x: x[0],reverse = True) # largest first
+        if self.gene.strand == "+":
+#           if self.transcript[starts[0][1]].cds:
+#               if (int(re.sub("[<>]","",self.transcript[starts[0][1]].exons[0].start)) 
+#                   == int(re.sub("[<>]","",self.transcript[starts[0][1]].cds[0].start))):
+#                   self.gene.start = "<" + self.gene.start
+#                   self.fiveprime_complete = False
+#                   self.fiveprime_checked = True
+#               if (int(re.sub("[<>]","",self.transcript[stops[0][1]].exons[-1].end))
+#                   == int(re.sub("[<>]","",self.transcript[stops[0][1]].cds[-1].end))):
+#                   self.gene.end = ">" + self.gene.end
+#                   self.threeprime_complete = False
+#                   self.threeprime_checked = True
+#           else:
+#               self.fiveprime_complete = False
+#               self.fiveprime_checked = True
+#               self.threeprime_complete = False
+#               self.threeprime_checked = True
+            if not self.transcript[starts[0][1]].fiveprime_checked:
+                self.transcript[starts[0][1]].check_fiveprime_complete()
+            self.fiveprime_complete = self.transcript[starts[0][1]].fiveprime_complete
+            self.fiveprime_checked = True
+            if not self.transcript[stops[0][1]].threeprime_checked:
+                self.transcript[stops[0][1]].check_threeprime_complete()
+            self.threeprime_complete = self.transcript[stops[0][1]].threeprime_complete
+            self.threeprime_checked = True
+            if not self.fiveprime_complete:
+                self.gene.start = "<" + self.gene.start
+            if not self.threeprime_complete:
+                self.gene.end = ">" + self.gene.end
+        if self.gene.strand == "-":
+#           if self.transcript[starts[0][1]].cds:
+#               if (int(re.sub("[<>]","",self.transcript[starts[0][1]].exons[0].start)) 
+#                   == int(re.sub("[<>]","",self.transcript[starts[0][1]].cds[0].start))):
+#                   self.gene.start = ">" + self.gene.start
+#                   self.threeprime_complete = False
+#                   self.threeprime_checked = True
+#               if (int(re.sub("[<>]","",self.transcript[stops[0][1]].exons[-1].end))
+#                   == int(re.sub("[<>]","",self.transcript[stops[0][1]].cds[-1].end))):
+#                   self.gene.end = "<" + self.gene.end
+#                   self.fiveprime_complete = False
+#                   self.fiveprime_checked = True
+#           else:
+#               self.fiveprime_complete = False
+#               self.fiveprime_checked = True
+#               self.threeprime_complete = False
+#               self.threeprime_checked = True
+            if not self.transcript[stops[0][1]].fiveprime_checked:
+                self.transcript[stops[0][1]].check_fiveprime_complete()
+            self.fiveprime_complete = self.transcript[stops[0][1]].fiveprime_complete
+            self.fiveprime_checked = True
+            if not self.transcript[starts[0][1]].threeprime_checked:
+                self.transcript[starts[0][1]].check_threeprime_complete()
+            self.threeprime_complete = self.transcript[starts[0][1]].threeprime_complete
+            self.threeprime_checked = True
+            if not self.fiveprime_complete:
+                self.gene.end = "<" + self.gene.end
+            if not self.threeprime_complete:
+                self.gene.start = ">" + self.gene.start
 
     def __init__(self,gene):
         self.gene = gene
@@ -717,4 +638,869 @@ class Gene(object):
         self.threeprime_checked = False
 
 
+def check_codons(transcripts,genome):
+    """Check the start and stop codons of many transcripts at once.
+
+    Collects every transcript's codon windows, sorts them by scaffold
+    and position, and reads them from genome (an IndexedFasta or
+    PackedGenome from fastatools.open_genome) in that order, so the
+    scaffolds themselves are never loaded. Results are kept on each
+    Transcript (see set_codons); transcripts without CDS are skipped.
+
+    """
+    windows = []
+    for transcript in transcripts:
+        if transcript.cds and not transcript.codons_checked:
+            seqid = transcript.transcript.seqid
+            for which,(first,last) in enumerate(transcript.codon_windows()):
+                windows.append((seqid,first,last,which,transcript))
+    windows.sort(key=lambda x: x[:3])
+    codons = {}
+    for seqid,first,last,which,transcript in windows:
+        codons.setdefault(transcript,[None,None])[which] = genome.fetch(seqid,first + 1,last)
+    for transcript,pair in codons.iteritems():
+        transcript.set_codons(*pair)
+
+
+# .tbl record templates
+TBL_HEADER = ">Feature %s\n1\t%d\tREFERENCE\n\t\t\tPBARC\t12345\n"
+TBL_GENE = "%s\t%s\tgene\n\t\t\tlocus_tag\t%s\n"
+TBL_SPAN = "%s\t%s\t%s\n"
+TBL_SEG = "%s\t%s\n"
+TBL_QUALIFIER = "\t\t\t%s\t%s\n"
+TBL_IDS = ("\t\t\tprotein_id\tgnl|BCGSC|%s\n"
+           "\t\t\ttranscript_id\tgnl|BCGSC|%s_mRNA\n")
+TBL_CODON_START = "\t\t\tcodon_start\t1\n"
+TBL_NCRNA_CLASS = "\t\t\tncRNA_class\tlncRNA\n"
+
+class TblWriter(object):
+
+    """Render genes and transcripts as NCBI .tbl records.
+
+    Records are filled in from the TBL_* templates and collected in a
+    buffer, which is written to outfile in one go whenever it passes
+    buffer_size characters (and on flush). Without an outfile the text
+    is kept until getvalue() is called.
+
+    Partial marks are applied first (Gene.check_complete and
+    Transcript.check_complete), as print_gene and print_transcript do.
+
+    outfile: an open file to write to [None]
+    buffer_size: characters to collect before writing [1048576]
+
+    Methods:
+    write_header
+    write_gene
+    write_transcript
+    write
+    flush
+    getvalue
+
+    """
+
+    def write_header(self,seqid,length):
+        """Start a scaffold's >Feature table."""
+        self._emit(TBL_HEADER % (seqid,length))
+
+    def write_gene(self,gene):
+        """Write a gene line and its locus_tag. Expects partial marks to
+        have been applied already (Gene.check_complete)."""
+        feature = gene.gene
+        if feature.strand == "-":
+            self._emit(TBL_GENE % (feature.end,feature.start,
+                                   feature.locus_tag or feature.id))
+        elif feature.strand == "+":
+            self._emit(TBL_GENE % (feature.start,feature.end,
+                                   feature.locus_tag or feature.id))
+
+    def write_transcript(self,transcript,product_type=None,sequence=None):
+        """Write a transcript's exons, then its CDS segments if any.
+
+        product_type = 'mRNA' or 'ncRNA'
+        sequence = genomic scaffold sequence (for CDS completeness assessment)
+
+        The record is rendered in full before anything is buffered, so
+        a transcript that fails leaves no partial record behind.
+
+        """
+        if product_type is None:
+            product_type = 'mRNA'
+        transcript.check_complete(sequence)
+        if not transcript.exons and not transcript.cds:
+            raise ValueError("Transcript " + transcript.transcript.id +
+                             " has no exons or CDS segments")
+        record = []
+        if transcript.exons:
+            self._segments(record,transcript,transcript.exons,product_type)
+        if transcript.cds:
+            self._segments(record,transcript,transcript.cds,"CDS")
+        self._emit("".join(record))
+
+    def write(self,text):
+        """Add already rendered .tbl text (e.g. a cached record)."""
+        self._emit(text)
+
+    def _segments(self,record,transcript,segments,label):
+        # segments in transcript order, with the transcript's qualifiers
+        # after the first line of a single segment or after the last one
+        if transcript.strand == "-":
+            segments = segments[::-1]
+        first = segments[0]
+        if first.type == "CDS" or label == "mRNA" or label == "ncRNA":
+            record.append(TBL_SPAN % (self._span(first) + (label,)))
+        else:
+            record.append("\n")
+        if len(segments) > 1:
+            for segment in segments[1:]:
+                record.append(TBL_SEG % self._span(segment))
+
+        last = segments[-1]
+        tr = transcript.transcript
+        if last.type == "CDS":
+            self._product(record,tr,True)
+            if tr.note:
+                record.append(TBL_QUALIFIER % ("note",tr.note))
+            record.append(TBL_CODON_START)
+            name = tr.locus_tag or last.parent[0]
+            record.append(TBL_IDS % (name,name))
+        else:
+            if label == "ncRNA" and len(segments) == 1:
+                record.append(TBL_NCRNA_CLASS)
+            self._product(record,tr,False)
+            if tr.note:
+                record.append(TBL_QUALIFIER % ("note",tr.note))
+            if label == "mRNA":
+                name = tr.locus_tag or last.parent[0]
+                record.append(TBL_IDS % (name,name))
+            if label == "ncRNA" and len(segments) > 1:
+                record.append(TBL_NCRNA_CLASS)
+
+    def _span(self,segment):
+        if segment.strand == "-":
+            return (segment.end,segment.start)
+        return (segment.start,segment.end)
+
+    def _product(self,record,tr,desc):
+        # 'similar to' products go to prot_desc (on CDS only), with the
+        # locus_tag standing in as the product
+        if not tr.product:
+            return
+        if "similar" in tr.product:
+            record.append(TBL_QUALIFIER % ("product",tr.locus_tag or tr.parent[0]))
+            if desc:
+                record.append(TBL_QUALIFIER % ("prot_desc",tr.product))
+        else:
+            record.append(TBL_QUALIFIER % ("product",tr.product))
+
+    def _emit(self,text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.outfile is not None and self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write out the buffer (if there is an outfile)."""
+        if self.outfile is not None and self.buffer:
+            self.outfile.write("".join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def getvalue(self):
+        """Return (and clear) the buffered text."""
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        return text
+
+    def __init__(self,outfile=None,buffer_size=1048576):
+        self.outfile = outfile
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+
+class GeneBuilder(object):
+
+    """Assemble GFF features into Gene objects as they are read.
+
+    Genes are indexed by ID and transcripts (mRNA/ncRNA) by their own
+    ID, so each exon or CDS segment attaches to its parent(s) with a
+    dict lookup. Features that arrive before their parent (e.g. in an
+    unsorted file) are held in 'orphans', keyed by the missing parent
+    ID, and attached as soon as that parent is added. Anything left in
+    'orphans' at the end never found its parent.
+
+    Methods:
+    add
+    update
+
+    """
+
+    def add(self,feature):
+        """Add a GFF feature; types other than gene, mRNA, ncRNA, exon
+        and CDS are ignored."""
+        if feature.type == "gene":
+            self.genes[feature.id] = Gene(feature)
+            self._adopt(feature.id)
+        elif feature.type == "mRNA" or feature.type == "ncRNA":
+            # transcripts can only have one parent, so access it explicitly
+            self._attach(feature,feature.parent[0])
+        elif feature.type == "exon" or feature.type == "CDS":
+            # a segment shared by several transcripts is copied for each
+            #  one after the first, as partial marks and widened introns
+            #  change it per transcript
+            for i,parent in enumerate(feature.parent):
+                self._attach(feature.copy() if i else feature,parent)
+
+    def update(self,other):
+        """Merge in the genes, transcripts and orphans of another
+        GeneBuilder (e.g. one built from another part of the same
+        file). Orphans on either side whose parent the other builder
+        has are attached."""
+        self.genes.update(other.genes)
+        self.transcripts.update(other.transcripts)
+        if self.orphans:
+            for parent in other.genes.keys() + other.transcripts.keys():
+                self._adopt(parent)
+        for parent,features in other.orphans.iteritems():
+            for feature in features:
+                self._attach(feature,parent)
+
+    def _attach(self,feature,parent):
+        if feature.type == "exon" or feature.type == "CDS":
+            if parent not in self.transcripts:
+                self.orphans.setdefault(parent,[]).append(feature)
+            elif feature.type == "exon":
+                self.transcripts[parent].add_exon(feature)
+            else:
+                self.transcripts[parent].add_cds(feature)
+        elif parent not in self.genes:
+            self.orphans.setdefault(parent,[]).append(feature)
+        else:
+            self.genes[parent].add_transcript(feature)
+            self.transcripts[feature.id] = self.genes[parent].transcript[feature.id]
+            self._adopt(feature.id)
+
+    def _adopt(self,parent):
+        for feature in self.orphans.pop(parent,[]):
+            self._attach(feature,parent)
+
+    def __init__(self):
+        self.genes = {}
+        self.transcripts = {}
+        self.orphans = {}
+
+
+# chunks per process, so a few large scaffolds don't leave processes idle
+CHUNKS_PER_JOB = 4
+
+def gff_chunks(file_name,count):
+    """Split a gff into about 'count' byte ranges that begin on new scaffolds.
+
+    Returns a list of (start, end) byte offsets covering the file. Each
+    boundary is moved forward from an even split to the first line
+    whose seqid differs from the line before it, so as long as each
+    scaffold's lines are together (e.g. the gff is sorted by seqid) no
+    scaffold is split between ranges. Comment lines and lines without
+    tabs (e.g. an embedded ##FASTA section) never end a scaffold.
+
+    """
+    size = os.path.getsize(file_name)
+    bounds = [0]
+    with open(file_name,"rb") as infile:
+        for i in xrange(1,count):
+            target = max(size * i // count,bounds[-1])
+            if target >= size:
+                break
+            infile.seek(target)
+            if target:
+                # skip the rest of the line the split landed in
+                infile.readline()
+            seqid = None
+            while True:
+                pos = infile.tell()
+                line = infile.readline()
+                if not line:
+                    pos = size
+                    break
+                if line[0] == "#" or "\t" not in line:
+                    continue
+                this = line.split("\t",1)[0]
+                if seqid is not None and this != seqid:
+                    break
+                seqid = this
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return zip(bounds[:-1],bounds[1:])
+
+
+def _scaffold_builders(lines):
+    """Yield (seqid, GeneBuilder) for each run of gff lines on one
+    scaffold, stopping at a ##FASTA section."""
+    seqid = None
+    builder = None
+    for line in lines:
+        if line[0] == "#":
+            if line.startswith("##FASTA"):
+                break
+            continue
+        if "\t" not in line:
+            continue
+        feature = GFF(line)
+        if feature.seqid != seqid:
+            if builder is not None:
+                yield seqid,builder
+            seqid = feature.seqid
+            builder = GeneBuilder()
+        builder.add(feature)
+    if builder is not None:
+        yield seqid,builder
+
+
+def _chunk_lines(file_name,start,end):
+    """Yield the lines of a file from byte offset start up to end."""
+    with open(file_name,"rb") as infile:
+        infile.seek(start)
+        pos = start
+        while pos < end:
+            line = infile.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def _read_chunk(job):
+    """Pool worker: the (seqid, GeneBuilder) groups of one byte range,
+    or (seqid, func(seqid, builder)) if given a func."""
+    file_name,start,end,func = job
+    groups = _scaffold_builders(_chunk_lines(file_name,start,end))
+    if func is None:
+        return list(groups)
+    return [(seqid,func(seqid,builder)) for seqid,builder in groups]
+
+
+def read_scaffolds(file_name,jobs=1,func=None,threads=1):
+    """Read a gff into Gene objects, yielding (seqid, GeneBuilder) for
+    each run of lines on one scaffold, in file order.
+
+    With jobs > 1 the file is split by gff_chunks and the chunks are
+    parsed in a pool of that many processes. This needs a seekable,
+    uncompressed file; anything else (gzip, or "-" for stdin) is read
+    serially. Either way a scaffold whose lines are not all together
+    comes out as more than one group, which callers can check for, and
+    exons or CDS whose transcript is in another group are left in that
+    group's orphans (see GeneBuilder.update to merge groups).
+
+    Sending the genes back from the pool costs nearly as much as
+    parsing them, so where the per-scaffold work allows, pass a
+    module-level func(seqid, builder): it is run in the pool and
+    (seqid, its result) is yielded instead.
+
+    threads is passed to open_file, so a compressed gff read serially
+    can be decompressed by pigz or bgzip with that many threads.
+
+    """
+    if jobs > 1 and file_name != "-":
+        with open(file_name,"rb") as infile:
+            compressed = infile.read(2) == fastatools.GZIP_MAGIC
+        if not compressed:
+            chunks = gff_chunks(file_name,jobs * CHUNKS_PER_JOB)
+            pool = Pool(jobs)
+            try:
+                for groups in pool.imap(_read_chunk,
+                                        ((file_name,start,end,func) for start,end in chunks)):
+                    for group in groups:
+                        yield group
+            finally:
+                pool.terminate()
+                pool.join()
+            return
+    with open_file(file_name,threads) as infile:
+        for seqid,builder in _scaffold_builders(infile):
+            yield seqid,(builder if func is None else func(seqid,builder))
+
+
+class Categories(object):
+
+    """Intern repeated strings (seqids, types, sources) as small ints.
+
+    values[code] gives back the string; code(value) assigns the next
+    free code to strings not seen before.
+
+    """
+
+    def code(self,value):
+        try:
+            return self.codes[value]
+        except KeyError:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+            return self.codes[value]
+
+    def __getitem__(self,code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+
+# strand and phase column values <-> codes stored in FeatureTable
+STRAND_CODES = {"+": 1, "-": -1, ".": 0, "?": 2}
+STRANDS = {1: "+", -1: "-", 0: ".", 2: "?"}
+PHASE_CODES = {"0": 0, "1": 1, "2": 2, ".": -1}
+PHASES = {0: "0", 1: "1", 2: "2", -1: "."}
+
+# FeatureTable snapshot files: header, then the columns, then string pools
+SNAPSHOT_MAGIC = "GFTS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = ("seqid","source","type","score","start","end","strand","phase")
+
+def _file_md5(file_name):
+    digest = hashlib.md5()
+    with open(file_name,"rb") as infile:
+        for block in iter(lambda: infile.read(1048576),""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class FeatureTable(object):
+
+    """Columnar (struct-of-arrays) store of GFF features.
+
+    Row i of the table is one GFF line. seqid, source, type and score
+    are stored as Categories codes, start/end/strand/phase in typed
+    arrays, and the ID, Parent and column 9 text in string pools
+    (Parent strings are interned, since exons and CDS of a transcript
+    share them). This is far smaller than one GFF object per line.
+
+    Rows can be filtered by type/seqid/source/region with rows(),
+    turned back into GFF objects with feature(), and assembled into
+    Gene/Transcript objects on demand with genes(), so only the part
+    of the annotation being worked on is ever materialized.
+
+    Methods:
+    append
+    add_line
+    from_file
+    cached
+    save
+    load
+    rows
+    line
+    feature
+    genes
+
+    """
+
+    def append(self,feature):
+        """Add a GFF object (eager or lazy) as a new row."""
+        self.seqid.append(self.seqids.code(feature.seqid))
+        self.source.append(self.sources.code(feature.source))
+        self.type.append(self.types.code(feature.type))
+        self.score.append(self.scores.code(feature.score))
+        self.start.append(int(feature.start))
+        self.end.append(int(feature.end))
+        self.strand.append(STRAND_CODES[feature.strand])
+        self.phase.append(PHASE_CODES[feature.offset])
+        self.ids.append(feature.id)
+        self.parents.append(intern(",".join(feature.parent)))
+        self.attributes.append(feature.attributes)
+        self._children = None
+
+    def add_line(self,line):
+        """Add a raw GFF line as a new row."""
+        self.append(GFF(line,lazy=True))
+
+    @classmethod
+    def from_file(cls,gff,threads=1):
+        """Load every feature in a (possibly compressed) GFF file,
+        decompressing with up to 'threads' threads (see open_file)."""
+        table = cls()
+        with open_file(gff,threads) as infile:
+            for line in infile:
+                if line.startswith("##FASTA"):
+                    break
+                if line[0] == "#" or not line.strip():
+                    continue
+                table.add_line(line)
+        return table
+
+    @classmethod
+    def cached(cls,gff,snapshot=None,threads=1):
+        """Load a GFF file through a snapshot of its table.
+
+        The snapshot (gff + '.fts' by default) is used if it is still
+        valid for gff (see load); otherwise the GFF is parsed and the
+        snapshot rewritten, if the directory allows it.
+
+        """
+        if snapshot is None:
+            snapshot = gff + ".fts"
+        if os.path.isfile(snapshot):
+            try:
+                return cls.load(snapshot,gff)
+            except ValueError:
+                pass
+        table = cls.from_file(gff,threads)
+        try:
+            table.save(snapshot,gff)
+        except IOError:
+            pass
+        return table
+
+    def save(self,file_name,source=None):
+        """Write the table to a binary snapshot file.
+
+        The columns are stored as raw array bytes and the string pools
+        as newline-joined blocks, so loading needs no parsing. If
+        source (the GFF the table came from) is given, its size, mtime
+        and MD5 are recorded so load can spot a stale snapshot.
+
+        """
+        if source is None:
+            stamp = (0,0.0,"")
+        else:
+            stamp = (os.path.getsize(source),os.path.getmtime(source),
+                     _file_md5(source))
+        with open(file_name,"wb") as out:
+            out.write(struct.pack("<4sIQd32s",SNAPSHOT_MAGIC,SNAPSHOT_VERSION,
+                                  stamp[0],stamp[1],stamp[2]))
+            for name in SNAPSHOT_COLUMNS:
+                column = getattr(self,name)
+                out.write(struct.pack("<cBQ",column.typecode,column.itemsize,
+                                      len(column)))
+                column.tofile(out)
+            for strings in self._pools():
+                blob = "\n".join(strings)
+                out.write(struct.pack("<QQ",len(strings),len(blob)))
+                out.write(blob)
+
+    @classmethod
+    def load(cls,file_name,source=None):
+        """Read a table back from a snapshot written by save.
+
+        The file is memory-mapped and each column copied out in one
+        go. If source is given, the snapshot must have been saved from
+        it: the size must match, and so must either the mtime or (if
+        the file was touched) the MD5. Raises ValueError if the
+        snapshot is stale or not a snapshot.
+
+        """
+        with open(file_name,"rb") as infile:
+            try:
+                data = mmap.mmap(infile.fileno(),0,access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(file_name + " is not a FeatureTable snapshot")
+        try:
+            head = struct.Struct("<4sIQd32s")
+            if len(data) < head.size:
+                raise ValueError(file_name + " is not a FeatureTable snapshot")
+            magic,version,size,mtime,md5 = head.unpack_from(data,0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError(file_name + " is not a FeatureTable snapshot")
+            if source is not None:
+                if (os.path.getsize(source) != size or
+                    (os.path.getmtime(source) != mtime and _file_md5(source) != md5)):
+                    raise ValueError(file_name + " is out of date for " + source)
+            table = cls()
+            pos = head.size
+            for name in SNAPSHOT_COLUMNS:
+                typecode,itemsize,count = struct.unpack_from("<cBQ",data,pos)
+                pos += struct.calcsize("<cBQ")
+                column = array(typecode)
+                if column.itemsize != itemsize:
+                    raise ValueError(file_name + " was written on another platform")
+                column.fromstring(data[pos:pos + count * itemsize])
+                pos += count * itemsize
+                setattr(table,name,column)
+            pools = []
+            for _ in range(7):
+                count,length = struct.unpack_from("<QQ",data,pos)
+                pos += 16
+                pools.append(data[pos:pos + length].split("\n") if count else [])
+                pos += length
+        finally:
+            data.close()
+        for categories,values in zip((table.seqids,table.sources,table.types,
+                                      table.scores),pools[:4]):
+            categories.values = values
+            categories.codes = dict((value,code) for code,value in enumerate(values))
+        table.ids = pools[4]
+        table.parents = map(intern,pools[5])
+        table.attributes = pools[6]
+        return table
+
+    def _pools(self):
+        return (self.seqids.values,self.sources.values,self.types.values,
+                self.scores.values,self.ids,self.parents,self.attributes)
+
+    def __len__(self):
+        return len(self.start)
+
+    def rows(self,type=None,seqid=None,source=None,start=None,end=None):
+        """Return the indices of rows matching all the given filters.
+
+        type, seqid, source: exact column values
+        start, end: keep rows overlapping this (1-based, inclusive)
+            region; either may be omitted for an open-ended region
+
+        Each filter is a single pass over one column, done with
+        itertools rather than a Python-level loop over rows.
+
+        """
+        selected = None # all rows
+        for column,categories,value in ((self.type,self.types,type),
+                                        (self.seqid,self.seqids,seqid),
+                                        (self.source,self.sources,source)):
+            if value is None:
+                continue
+            if value not in categories.codes:
+                return []
+            selected = self._narrow(selected,column,
+                                    partial(eq,categories.codes[value]))
+        if start is not None:
+            selected = self._narrow(selected,self.end,partial(le,start))
+        if end is not None:
+            selected = self._narrow(selected,self.start,partial(ge,end))
+        if selected is None:
+            return range(len(self))
+        return selected
+
+    def _narrow(self,selected,column,test):
+        if selected is None:
+            return list(compress(xrange(len(self)),imap(test,column)))
+        return [i for i in selected if test(column[i])]
+
+    def line(self,i):
+        """Rebuild the GFF line for row i."""
+        return "\t".join([self.seqids[self.seqid[i]],self.sources[self.source[i]],
+                          self.types[self.type[i]],str(self.start[i]),
+                          str(self.end[i]),self.scores[self.score[i]],
+                          STRANDS[self.strand[i]],PHASES[self.phase[i]],
+                          self.attributes[i]]) + "\n"
+
+    def feature(self,i,lazy=False):
+        """Materialize row i as a GFF object."""
+        return GFF(self.line(i),lazy)
+
+    def children(self,parent):
+        """Return the rows whose Parent includes the given ID."""
+        if self._children is None:
+            self._children = {}
+            for i,parents in enumerate(self.parents):
+                if parents:
+                    for papa in parents.split(","):
+                        self._children.setdefault(papa,[]).append(i)
+        return self._children.get(parent,[])
+
+    def genes(self,seqid=None,start=None,end=None):
+        """Build Gene objects for the genes in a scaffold or region.
+
+        Returns a dict of gene ID -> Gene, as gff3-to-tbl.py builds,
+        with each gene's mRNA/ncRNA transcripts and their exons and
+        CDS segments. Only the rows belonging to those genes are
+        materialized.
+
+        """
+        genes = {}
+        for i in self.rows("gene",seqid,None,start,end):
+            gene = Gene(self.feature(i))
+            genes[gene.id] = gene
+            for j in self.children(gene.id):
+                if self.types[self.type[j]] not in ("mRNA","ncRNA"):
+                    continue
+                transcript = self.feature(j)
+                gene.add_transcript(transcript)
+                # each transcript gets its own segment features, even where
+                #  a line is shared, as partial marks change them
+                for k in self.children(transcript.id):
+                    kind = self.types[self.type[k]]
+                    if kind == "exon":
+                        gene.transcript[transcript.id].add_exon(self.feature(k))
+                    elif kind == "CDS":
+                        gene.transcript[transcript.id].add_cds(self.feature(k))
+        return genes
+
+    def __init__(self):
+        self.seqids = Categories()
+        self.sources = Categories()
+        self.types = Categories()
+        self.scores = Categories()
+        self.seqid = array("i")
+        self.source = array("i")
+        self.type = array("i")
+        self.score = array("i")
+        self.start = array("l")
+        self.end = array("l")
+        self.strand = array("b")
+        self.phase = array("b")
+        self.ids = []
+        self.parents = []
+        self.attributes = []
+        self._children = None
+
+
+class RegionIndex(object):
+
+    """Index features by scaffold position.
+
+    Each scaffold's intervals are kept sorted by start in typed arrays
+    alongside a running maximum of their ends, so a query bisects to
+    the last interval starting before its end and walks back only
+    while intervals that far left can still reach it: O(log n + k)
+    when features don't nest deeply. Coordinates are 1-based and
+    inclusive, as in GFF. Queries return the stored items (GFF
+    objects, FeatureTable rows, ...) in start order.
+
+    features: GFF objects to index [()]
+
+    Methods:
+    add
+    add_region
+    from_table
+    overlap
+    contained
+    containing
+    nearest
+
+    """
+
+    def add(self,feature):
+        """Index a GFF object (eager or lazy) under its own coordinates."""
+        self.add_region(feature.seqid,feature.istart,feature.iend,feature)
+
+    def add_region(self,seqid,start,end,item):
+        """Index any item as covering seqid:start-end."""
+        self._pending.setdefault(seqid,[]).append((start,end,item))
+
+    @classmethod
+    def from_table(cls,table,type=None,seqid=None,source=None):
+        """Index FeatureTable rows (as row numbers), optionally filtered
+        as for FeatureTable.rows."""
+        index = cls()
+        for i in table.rows(type,seqid,source):
+            index.add_region(table.seqids[table.seqid[i]],table.start[i],
+                             table.end[i],i)
+        return index
+
+    def overlap(self,seqid,start,end):
+        """Return the items overlapping seqid:start-end."""
+        found = []
+        for i in self._overlap_rows(seqid,start,end):
+            found.append(self._items[seqid][i])
+        return found
+
+    def contained(self,seqid,start,end):
+        """Return the items lying entirely within seqid:start-end."""
+        if not self._ready(seqid):
+            return []
+        starts,ends,_,items = self._index(seqid)
+        found = []
+        for i in xrange(bisect_left(starts,start),bisect_right(starts,end)):
+            if ends[i] <= end:
+                found.append(items[i])
+        return found
+
+    def containing(self,seqid,start,end):
+        """Return the items spanning all of seqid:start-end."""
+        found = []
+        if not self._ready(seqid):
+            return found
+        starts,ends,reach,items = self._index(seqid)
+        i = bisect_right(starts,start) - 1
+        while i >= 0 and reach[i] >= end:
+            if ends[i] >= end:
+                found.append(items[i])
+            i -= 1
+        found.reverse()
+        return found
+
+    def nearest(self,seqid,start,end=None):
+        """Return (distance, item) for the item closest to seqid:start-end.
+
+        Overlapping items are at distance 0 (the first by start is
+        returned); otherwise the distance is the number of bases
+        between the region and the item. Returns None if nothing is
+        indexed on seqid.
+
+        """
+        if end is None:
+            end = start
+        if not self._ready(seqid):
+            return None
+        overlapping = self._overlap_rows(seqid,start,end)
+        starts,ends,reach,items = self._index(seqid)
+        if overlapping:
+            return (0,items[overlapping[0]])
+        best = None
+        i = bisect_right(starts,end)
+        if i < len(starts):
+            best = (starts[i] - end - 1,items[i])
+        if i > 0:
+            # the furthest-reaching interval to the left ends closest
+            left = self._reacher[seqid][i - 1]
+            distance = start - ends[left] - 1
+            if best is None or distance <= best[0]:
+                best = (distance,items[left])
+        return best
+
+    def _overlap_rows(self,seqid,start,end):
+        if not self._ready(seqid):
+            return []
+        starts,ends,reach,_ = self._index(seqid)
+        rows = []
+        i = bisect_right(starts,end) - 1
+        while i >= 0 and reach[i] >= start:
+            if ends[i] >= start:
+                rows.append(i)
+            i -= 1
+        rows.reverse()
+        return rows
+
+    def _ready(self,seqid):
+        # sort in any intervals added since the last query on seqid
+        if seqid in self._pending:
+            intervals = self._pending.pop(seqid)
+            if seqid in self._items:
+                intervals.extend(zip(self._starts[seqid],self._ends[seqid],
+                                     self._items[seqid]))
+            intervals.sort(key=lambda x: (x[0],x[1]))
+            self._starts[seqid] = array("l",[x[0] for x in intervals])
+            self._ends[seqid] = array("l",[x[1] for x in intervals])
+            self._items[seqid] = [x[2] for x in intervals]
+            reach = array("l")
+            reacher = array("l")
+            for i,interval in enumerate(intervals):
+                if not reach or interval[1] > reach[-1]:
+                    reach.append(interval[1])
+                    reacher.append(i)
+                else:
+                    reach.append(reach[-1])
+                    reacher.append(reacher[-1])
+            self._reach[seqid] = reach
+            self._reacher[seqid] = reacher
+        return seqid in self._items
+
+    def _index(self,seqid):
+        return (self._starts[seqid],self._ends[seqid],self._reach[seqid],
+                self._items[seqid])
+
+    def __init__(self,features=()):
+        self._pending = {}
+        self._starts = {}
+        self._ends = {}
+        self._reach = {}
+        self._reacher = {}
+        self._items = {}
+        for feature in features:
+            self.add(feature)
+
+
 ### EOF ###
@@ -1,10 +1,11 @@
 #!/usr/bin/env python
 
 import sys
+import hashlib
 
 import argparse
 
-from fastatools import fasta_iter
+from fastatools import IndexedFasta, fasta_iter, open_file
 
 
 parser = argparse.ArgumentParser(
@@ -18,38 +19,67 @@ oldsqn = args.OldFASTA
 if args.NewFASTA:
     newsqn = args.NewFASTA
 
-# read in old scaffs with sqn as key and id as value
-# then read in new scaffs and compare sqn to keys and write out old and new ids upon match
+# read in old scaffs with a digest of the sqn as key and id as value
+# then read in new scaffs and compare digests to keys and write out old and new ids upon match
 # or, if only one FASTA given, output unique sequences
+# sequences are memory-mapped views and are hashed piecewise, so they are never
+# held in memory whole, unless the fasta can't be indexed (plain gzip, or uneven
+# line lengths)
+
+def records(fasta_name):
+    """yield (ID, whole header or None, sequence) for each record. the sequence
+    is a view from the index where possible, else a string with its header"""
+    try:
+        fasta = IndexedFasta(fasta_name)
+    except ValueError:
+        with open_file(fasta_name) as infile:
+            for header, sqn in fasta_iter(infile):
+                yield header.split()[0], header, sqn
+        return
+    for name in fasta:
+        yield name, None, fasta[name]
+
+def digest(sqn):
+    md5 = hashlib.md5()
+    if isinstance(sqn, str):
+        md5.update(sqn)
+    else:
+        for piece in sqn.chunks():
+            md5.update(piece)
+    # include the length to make accidental matches even less likely
+    return md5.digest() + str(len(sqn))
 
 seqdict = {}
 
 collisions = open("collisions.txt","w")
 
-with open(oldsqn,"r") as infile:
-    for rec in fasta_iter(infile):
-        seqid = rec[0]
-        sqn = rec[1]
-        if sqn in seqdict:
-            print >> collisions, "Collision between " + seqid + " AND previously added " + seqdict[sqn]
-        else:
-            seqdict[sqn] = seqid
+for seqid, header, sqn in records(oldsqn):
+    key = digest(sqn)
+    if key in seqdict:
+        print >> collisions, "Collision between " + seqid + " AND previously added " + seqdict[key][0]
+    else:
+        seqdict[key] = (seqid, header, sqn)
 collisions.close()
 
 if args.NewFASTA:
     print "OldID\tNewID"
 
-    with open(newsqn,"r") as infile:
-        for rec in fasta_iter(infile):
-            seqid = rec[0]
-            sqn = rec[1]
-            if sqn in seqdict:
-                print seqdict[sqn] + "\t" + seqid
+    for seqid, header, sqn in records(newsqn):
+        key = digest(sqn)
+        if key in seqdict:
+            print seqdict[key][0] + "\t" + seqid
 else:
     # write out unique sequences
-    for sqn, sid in seqdict.items():
-        print ">" + sid
-        print sqn
+    # with the whole header line, not just the ID the index keys it by
+    for sid, header, sqn in seqdict.values():
+        if header is None:
+            print ">" + sqn.fasta.header(sid)
+            for piece in sqn.chunks():
+                sys.stdout.write(piece)
+            sys.stdout.write("\n")
+        else:
+            print ">" + header
+            print sqn
 
 
 ### EOF ###
@@ -2,14 +2,14 @@
 
 import sys
 
-from fastatools import fasta_iter
+from fastatools import fasta_iter, open_file
 
 
 fasta = sys.argv[1]
 
 sys.stdout.write("seqname\tseqlength\tnumN\tpctN\n")
 
-with open(fasta,"r") as infile:
+with open_file(fasta) as infile:
     for rec in fasta_iter(infile):
         nam = rec[0]
         seqn = rec[1]
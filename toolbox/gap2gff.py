@@ -6,6 +6,7 @@ import argparse
 from itertools import groupby
 
 from fastatools import fasta_iter as f
+from fastatools import open_file
 
 parser = argparse.ArgumentParser(description="Collect runs of N in scaffolds and write out positions as gff.")
 parser.add_argument('scaffolds', action='store', help='The fasta file of scaffolds')
@@ -60,7 +61,7 @@ def getgaps(seqname, seq):
 ## main
 #
 scaffolds = []
-with open(args.scaffolds,'r') as fasta:
+with open_file(args.scaffolds) as fasta:
     for scaf in f(fasta):
         scaffolds.append(scaf)
 
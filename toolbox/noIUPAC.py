@@ -2,13 +2,13 @@
 
 import sys
 
-from fastatools import fasta_iter
+from fastatools import fasta_iter, open_file
 
 infile = sys.argv[1]
 
 bueno = ["A","C","G","T","N"]
 
-with open(infile,"r") as fasta:
+with open_file(infile) as fasta:
     for rec in fasta_iter(fasta):
         seqn = rec[1].upper()
         nam = ">" + rec[0]
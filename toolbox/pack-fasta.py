@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import sys
+
+from fastatools import open_file, pack_fasta, save_packed
+
+def main():
+    """Pack a FASTA file into fastatools' 2-bit packed sequence format.
+
+    A, C, G and T take a quarter byte each; N runs, IUPAC codes and
+    soft-masking are kept exactly. The packed file can be given to
+    gff3-to-tbl.py and extract-cds.py in place of the FASTA.
+
+    Usage: pack-fasta.py genome.fa genome.pkseq
+    genome.fa may be gzip or bgzip compressed
+    """
+
+    fasta = sys.argv[1]
+    outfile = sys.argv[2]
+
+    with open_file(fasta) as file_object:
+        save_packed(pack_fasta(file_object), outfile)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print main.__doc__
+        sys.exit(1)
+    main()
+
+### EOF ###
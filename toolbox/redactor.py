@@ -3,6 +3,8 @@
 import sys
 import re
 
+from fastatools import open_file
+
 
 def redact(scaffold, min_length):
     """'redact' bases in scaftigs less than 50 bp long by replacing with N"""
@@ -29,7 +31,7 @@ def redact(scaffold, min_length):
 MINL = 50 # NCBI minimum scaftig length
 seqfile = sys.argv[1] # fasta file of scaffolds
 
-with open(seqfile,"r") as file_object:
+with open_file(seqfile) as file_object:
     for line in file_object:
         if line[0] == ">":
             sys.stdout.write(line)